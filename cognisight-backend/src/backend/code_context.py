@@ -0,0 +1,261 @@
+# code_context.py
+"""
+Code context extraction from uploaded project zips.
+
+Eligible members (by extension and declared size) are decoded and scanned for imports
+in chunks on the shared parse pool (pools.py); results are merged in sorted path order,
+so the context is identical to a serial scan. The general context is then filled in
+relevance order from the repo's import graph (import_graph.py); in plain path order the
+scan instead stops once the budgets are full and no more modules can be added. Members
+unchanged since the project's last upload come from its manifest (manifests.py) without
+being read.
+"""
+import io
+import os
+import re
+import zipfile
+from typing import Dict, List, Optional
+
+from import_graph import rank_files
+from manifests import ProjectManifest
+from pools import ordered_map
+
+# --- CONFIGURATION ---
+# Zip ingestion limits (zip-bomb protection): member count, total uncompressed size declared
+# by the archive, and the compression ratio of any member above 1 MiB.
+ZIP_MAX_MEMBERS = int(os.environ.get("COGNISIGHT_ZIP_MAX_MEMBERS", "20000"))
+ZIP_MAX_TOTAL_MB = int(os.environ.get("COGNISIGHT_ZIP_MAX_TOTAL_MB", "2048"))
+ZIP_MAX_RATIO = float(os.environ.get("COGNISIGHT_ZIP_MAX_RATIO", "100"))
+# Source files above this size never make it into the context, so they are not decompressed.
+MAX_SOURCE_FILE_BYTES = 12000
+# Context budgets (characters / entries) handed to the documentation pipeline.
+PRIORITY_CONTEXT_CHARS = 10000
+GENERAL_CONTEXT_CHARS = 15000
+MAX_MODULES = 30
+STRUCTURE_FILES = 60
+# "graph" fills the general context in import-graph relevance order (import_graph.py);
+# "path" keeps alphabetical order and may stop reading once the budgets are full.
+CONTEXT_RANKING = os.environ.get("COGNISIGHT_CONTEXT_RANKING", "graph")
+# Files per pool task, and the number of files to read below which parsing stays in-thread.
+PARSE_CHUNK_FILES = 128
+PARSE_PARALLEL_FILES = int(os.environ.get("COGNISIGHT_PARSE_PARALLEL_FILES", "512"))
+
+PRIORITY_FILES = {'package.json', 'requirements.txt', 'README.md', 'Dockerfile', 'docker-compose.yml', 'settings.py', 'config.js', 'pom.xml', 'build.gradle'}
+IGNORED_DIRS = {'node_modules', '.git', '__pycache__', 'dist', 'build', 'venv', '.idea', '.vscode', 'coverage', 'assets', 'images', 'bin', 'obj'}
+ALLOWED_EXTS = {'.py', '.js', '.jsx', '.ts', '.tsx', '.java', '.cpp', '.css', '.html', '.sql', '.json', '.yml', '.md', '.cs'}
+
+REGEX_PYTHON = re.compile(r'^(?:from|import)\s+([a-zA-Z0-9_]+)', re.MULTILINE)
+REGEX_JS = re.compile(r'(?:require\(|from\s+)[\'"]([@a-zA-Z0-9_\-/]+)[\'"]', re.MULTILINE)
+# Import targets inside the repo (edges of the import graph).
+REGEX_PYTHON_IMPORTS = re.compile(r'^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]*(?:\(([^)]*)\)|([\w., \t]+))|import[ \t]+([\w., \t]+))', re.MULTILINE)
+REGEX_JS_RELATIVE = re.compile(r'(?:require\(\s*|import\(\s*|from\s+|import\s+)[\'"](\.{1,2}/[^\'"]+)[\'"]')
+REGEX_PYTHON_MAIN = re.compile(r'^if\s+__name__\s*==\s*[\'"]__main__[\'"]', re.MULTILINE)
+ENTRY_POINT_FILES = {'main.py', 'app.py', 'server.py', 'manage.py', 'wsgi.py', 'asgi.py', 'cli.py', '__main__.py',
+                     'index.js', 'server.js', 'app.js', 'main.js', 'index.ts', 'main.ts', 'server.ts',
+                     'App.jsx', 'App.tsx', 'main.jsx', 'main.tsx', 'index.jsx', 'index.tsx'}
+
+
+class ZipLimitError(Exception):
+    pass
+
+
+def check_zip_limits(members: List[zipfile.ZipInfo]):
+    """Rejects archives that would cost far more to unpack than their upload size suggests."""
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise ZipLimitError(f"Archive has {len(members)} entries (limit {ZIP_MAX_MEMBERS}).")
+    total = sum(m.file_size for m in members)
+    if total > ZIP_MAX_TOTAL_MB * 2**20:
+        raise ZipLimitError(f"Archive unpacks to {total // 2**20} MB (limit {ZIP_MAX_TOTAL_MB} MB).")
+    for m in members:
+        if m.file_size > 2**20 and m.file_size > ZIP_MAX_RATIO * max(1, m.compress_size):
+            raise ZipLimitError(f"{m.filename} has a compression ratio above {ZIP_MAX_RATIO:g}.")
+
+
+def _python_imports(raw: str) -> List[str]:
+    """Dotted targets: `import a.b` -> a.b; `from a import b, c` -> a.b, a.c (resolved later)."""
+    targets = []
+    for source, wrapped, names, plain in REGEX_PYTHON_IMPORTS.findall(raw):
+        if wrapped:
+            # from a import (\n b,  # comment\n c,\n)
+            names = re.sub(r'#[^\n]*', '', wrapped)
+        if plain:
+            targets.extend(name.split()[0] for name in plain.split(',') if name.strip())
+            continue
+        for name in names.split(','):
+            name = name.split()[0] if name.strip() else ''
+            if name and name != '*':
+                targets.append(f"{source}.{name}" if not source.endswith('.') else source + name)
+    return targets
+
+def parse_source_file(filename: str, raw: str) -> Dict:
+    """Per-file parse result, as kept in the project manifest (entry is None for skipped files)."""
+    if len(raw) > MAX_SOURCE_FILE_BYTES or (len(raw) > 500 and raw.count('\n') < 3):
+        return {"priority": False, "entry": None, "modules": [], "imports": [], "entry_point": False}
+
+    ext = os.path.splitext(filename)[1].lower()
+    base_name = os.path.basename(filename)
+    modules = []
+    imports = []
+    # Module Extraction
+    if ext == '.py':
+        modules = REGEX_PYTHON.findall(raw)
+        imports = _python_imports(raw)
+    elif ext in ['.js', '.jsx', '.ts', '.tsx']:
+        modules = REGEX_JS.findall(raw)
+        imports = REGEX_JS_RELATIVE.findall(raw)
+    return {
+        "priority": base_name in PRIORITY_FILES,
+        "entry": f"\n\n--- FILE: {filename} ---\n{raw}\n",
+        "modules": list(dict.fromkeys(modules)),
+        "imports": list(dict.fromkeys(imports)),
+        "entry_point": base_name in ENTRY_POINT_FILES or (ext == '.py' and bool(REGEX_PYTHON_MAIN.search(raw))),
+    }
+
+
+def _parse_members(zip_source, names: List[str]) -> Dict[str, Optional[Dict]]:
+    """Pool task: manifest records for `names` (None for members that cannot be read)."""
+    if isinstance(zip_source, zipfile.ZipFile):
+        return _read_members(zip_source, names)
+    # Opened per chunk, so no pool process keeps the upload open after its task.
+    with zipfile.ZipFile(zip_source) as z:
+        return _read_members(z, names)
+
+
+def _read_members(z: zipfile.ZipFile, names: List[str]) -> Dict[str, Optional[Dict]]:
+    records = {}
+    for name in names:
+        info = z.getinfo(name)
+        try:
+            with z.open(info) as member:
+                raw = member.read(MAX_SOURCE_FILE_BYTES + 1).decode('utf-8', errors='ignore')
+        except Exception:
+            records[name] = None
+            continue
+        records[name] = {"crc": info.CRC, "size": info.file_size, **parse_source_file(name, raw)}
+    return records
+
+
+class _ContextParts:
+    """Collects entries and modules until the budgets are full (general entries: path order only)."""
+
+    def __init__(self, ranked: bool):
+        self.ranked = ranked
+        self.priority: List[str] = []
+        self.general: List[str] = []
+        self.priority_chars = 0
+        self.general_chars = 0
+        self.modules: Dict[str, None] = {}
+
+    def add(self, record: Dict):
+        entry = record["entry"]
+        if entry is not None:
+            if record["priority"] and self.priority_chars < PRIORITY_CONTEXT_CHARS:
+                self.priority.append(entry)
+                self.priority_chars += len(entry)
+            elif not record["priority"] and not self.ranked and self.general_chars < GENERAL_CONTEXT_CHARS:
+                self.general.append(entry)
+                self.general_chars += len(entry)
+        for module in record["modules"]:
+            if len(self.modules) >= MAX_MODULES:
+                break
+            self.modules.setdefault(module)
+
+    def fill_general(self, entries: List[str]):
+        for entry in entries:
+            if self.general_chars >= GENERAL_CONTEXT_CHARS:
+                break
+            self.general.append(entry)
+            self.general_chars += len(entry)
+
+    def full(self) -> bool:
+        # Ranked order needs every file: the most relevant one may come last alphabetically.
+        return (not self.ranked and self.priority_chars >= PRIORITY_CONTEXT_CHARS and self.general_chars >= GENERAL_CONTEXT_CHARS
+                and len(self.modules) >= MAX_MODULES)
+
+
+def parse_code_context(zip_source, manifest: Optional[ProjectManifest] = None) -> Dict[str, str]:
+    """
+    Analyzes zip (a path, or the archive bytes) to extract:
+    1. Structure, 2. Priority Context, 3. General Context, 4. Modules
+    Members unchanged since the project's last upload (same CRC and size in `manifest`)
+    are not read again; the manifest is updated with this upload's files. Members are
+    opened only when their declared size can make it into the context.
+    Raises ZipLimitError for archives over the ingestion limits.
+    """
+    manifest = manifest or ProjectManifest("")
+
+    try:
+        with zipfile.ZipFile(io.BytesIO(zip_source) if isinstance(zip_source, bytes) else zip_source) as z:
+            file_list = sorted(z.infolist(), key=lambda x: x.filename)
+
+            file_structure = [
+                info for info in file_list
+                if not info.is_dir() and not any(part in IGNORED_DIRS for part in info.filename.split('/'))
+            ]
+            candidates = [
+                info for info in file_structure
+                if (os.path.splitext(info.filename)[1].lower() in ALLOWED_EXTS
+                    or os.path.basename(info.filename) in PRIORITY_FILES)
+                and info.file_size <= MAX_SOURCE_FILE_BYTES
+            ]
+            # Only the members that can be decompressed count; ignored dirs (node_modules, .git, ...) are never read.
+            check_zip_limits(candidates)
+            chunks = [candidates[i:i + PARSE_CHUNK_FILES] for i in range(0, len(candidates), PARSE_CHUNK_FILES)]
+
+            # Worker processes open the archive themselves, so the pool needs a path.
+            to_read = sum(1 for info in candidates if manifest.unchanged(info.filename, info.CRC, info.file_size) is None)
+            parallel = isinstance(zip_source, str) and to_read >= PARSE_PARALLEL_FILES
+
+            def tasks():
+                for chunk in chunks:
+                    yield (zip_source if parallel else z,
+                           [info.filename for info in chunk
+                            if manifest.unchanged(info.filename, info.CRC, info.file_size) is None])
+
+            parts = _ContextParts(ranked=CONTEXT_RANKING == "graph")
+            results = ordered_map(_parse_members, tasks(), parallel)
+            scanned = 0
+            try:
+                for chunk, parsed in zip(chunks, results):
+                    for info in chunk:
+                        if info.filename in parsed:
+                            record = parsed[info.filename]
+                            if record is None:
+                                continue
+                            manifest.record(info.filename, record)
+                        else:
+                            record = manifest.unchanged(info.filename, info.CRC, info.file_size)
+                            manifest.reuse(info.filename, record)
+                        parts.add(record)
+                    scanned += len(chunk)
+                    if parts.full():
+                        break
+            finally:
+                results.close()
+
+            if parts.ranked:
+                records = {info.filename: manifest.files[info.filename]
+                           for info in candidates if info.filename in manifest.files}
+                general = [path for path, record in records.items() if record["entry"] is not None and not record["priority"]]
+                parts.fill_general(records[path]["entry"] for path in rank_files(records, general))
+
+            if scanned < len(candidates):
+                print(f"Context budgets full after {scanned} of {len(candidates)} files")
+                # Unread files keep their previous manifest entries for the next upload.
+                for info in candidates[scanned:]:
+                    record = manifest.unchanged(info.filename, info.CRC, info.file_size)
+                    if record is not None:
+                        manifest.keep(info.filename, record)
+
+    except ZipLimitError:
+        raise
+    except Exception as e:
+        print(f"Zip Error: {e}")
+        return {}
+
+    return {
+        "structure": "\n".join(info.filename for info in file_structure[:STRUCTURE_FILES]),
+        "priority_context": "".join(parts.priority)[:PRIORITY_CONTEXT_CHARS],
+        "general_context": "".join(parts.general)[:GENERAL_CONTEXT_CHARS],
+        "modules": ", ".join(list(parts.modules)[:MAX_MODULES])
+    }
@@ -0,0 +1,162 @@
+# doc_cache.py
+"""
+Content-addressed, on-disk caches of generated documentation.
+
+`doc_cache` holds finished jobs, keyed by a hash of everything the output depends on:
+the normalized code context, the heading list, the models (with precision and
+checkpoint mtime) and the generation parameters. `stage_cache` holds single stage
+outputs per heading, so a resubmission only reruns the stages whose inputs changed.
+`template_cache` holds the headings extracted from uploaded templates.
+One JSON file per entry; the least recently used entries are evicted once a
+directory exceeds its size budget (tracked as a running total, so a put does not
+rescan the directory until the budget is actually exceeded).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+# --- CONFIGURATION ---
+# Eviction frees space down to this fraction of the budget, so it does not rerun on every put.
+EVICT_TO_FRACTION = 0.9
+DOC_CACHE_ENABLED = os.environ.get("COGNISIGHT_DOC_CACHE", "1") == "1"
+DOC_CACHE_DIR = os.environ.get("COGNISIGHT_DOC_CACHE_DIR", "models/.doc_cache")
+DOC_CACHE_MB = int(os.environ.get("COGNISIGHT_DOC_CACHE_MB", "256"))
+STAGE_CACHE_DIR = os.environ.get("COGNISIGHT_STAGE_CACHE_DIR", "models/.stage_cache")
+STAGE_CACHE_MB = int(os.environ.get("COGNISIGHT_STAGE_CACHE_MB", "256"))
+TEMPLATE_CACHE_DIR = os.environ.get("COGNISIGHT_TEMPLATE_CACHE_DIR", "models/.template_cache")
+TEMPLATE_CACHE_MB = int(os.environ.get("COGNISIGHT_TEMPLATE_CACHE_MB", "16"))
+
+
+def normalize_context(context_data: Dict[str, str]) -> Dict[str, str]:
+    """Line endings and trailing whitespace must not change the key."""
+    return {
+        name: "\n".join(line.rstrip() for line in value.replace("\r\n", "\n").split("\n")).strip()
+        for name, value in sorted(context_data.items())
+    }
+
+
+def content_key(payload: Dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class DocCache:
+    def __init__(self, directory: str = DOC_CACHE_DIR, budget_mb: int = DOC_CACHE_MB, enabled: bool = DOC_CACHE_ENABLED):
+        self.directory = directory
+        self.budget_bytes = budget_mb * 2**20
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # Bytes on disk; None until the first put scans the directory.
+        self._total: Optional[int] = None
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, context_data: Dict[str, str], headings: List[str], models: List[Dict], params: Dict) -> str:
+        return content_key({
+            "context": normalize_context(context_data),
+            "headings": [h.strip() for h in headings],
+            "models": models,
+            "params": params,
+        })
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)["value"]
+            os.utime(path)  # mtime doubles as the LRU clock
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            with self._lock:
+                try:
+                    replaced = os.path.getsize(path)
+                except OSError:
+                    replaced = 0
+                os.replace(tmp, path)
+                self.stores += 1
+                if self._total is None:
+                    self._total = sum(size for _, size, _ in self._entries())
+                else:
+                    self._total += size - replaced
+                if self._total > self.budget_bytes:
+                    self._evict()
+        except OSError as e:
+            print(f"Doc cache write failed: {e}")
+
+    def _entries(self) -> List[tuple]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.budget_bytes * EVICT_TO_FRACTION
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._total = total
+
+    def stats(self) -> Dict:
+        entries = self._entries() if self.enabled else []
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(entries),
+                "size_mb": round(sum(size for _, size, _ in entries) / 2**20, 2),
+                "budget_mb": round(self.budget_bytes / 2**20),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+
+# Process-wide caches of finished documentation jobs, per-heading stage outputs and template headings.
+doc_cache = DocCache()
+stage_cache = DocCache(STAGE_CACHE_DIR, STAGE_CACHE_MB)
+template_cache = DocCache(TEMPLATE_CACHE_DIR, TEMPLATE_CACHE_MB)
@@ -0,0 +1,432 @@
+# generation.py
+"""
+Batched decoding for causal LMs.
+
+`model.generate` keeps every row of a batch alive until the longest one is done and
+pads prompts to the longest one. For the documentation stages we instead:
+  * group prompts into length buckets so left padding stays small,
+  * run one shared decode loop per bucket,
+  * drop finished rows (and their KV cache) from the batch as soon as they hit EOS,
+  * optionally prefill a prompt prefix shared by every row once and reuse its KV cache.
+
+Optionally rows can instead be decoded one at a time with assisted (speculative)
+decoding: an assistant proposes several tokens (copied from the prompt via n-gram
+lookup, or produced by a small draft model), the main model verifies them all in one
+forward pass and keeps the longest prefix it would have produced itself. Accepted
+tokens are exactly the ones plain decoding would pick, so greedy output is unchanged.
+"""
+import copy
+from typing import Callable, Dict, Hashable, List, Optional, Union
+
+from stopping import check_rules, finalize_text
+
+# Max fraction of a bucket's longest prompt that shorter prompts may be padded by.
+BUCKET_MAX_PAD_FRACTION = 0.2
+# Chat-template end-of-turn tokens; whichever exist in a vocabulary also end generation.
+END_MARKER_TOKENS = ["<end_of_turn>", "<|end|>", "<|im_end|>", "<|eot_id|>"]
+
+
+def length_buckets(lengths: Dict[Hashable, int], max_batch: int,
+                   max_pad_fraction: float = BUCKET_MAX_PAD_FRACTION) -> List[List[Hashable]]:
+    """Groups keys (longest first) so each bucket has at most `max_batch` similar-length prompts."""
+    buckets: List[List[Hashable]] = []
+    current: List[Hashable] = []
+    for key in sorted(lengths, key=lambda k: lengths[k], reverse=True):
+        if current and (len(current) >= max_batch
+                        or 1 - lengths[key] / max(lengths[current[0]], 1) > max_pad_fraction):
+            buckets.append(current)
+            current = []
+        current.append(key)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def eos_token_ids(model, tokenizer) -> set:
+    ids = set()
+    configured = getattr(model.generation_config, "eos_token_id", None)
+    if isinstance(configured, int):
+        ids.add(configured)
+    elif configured:
+        ids.update(configured)
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    vocab = tokenizer.get_vocab()
+    ids.update(vocab[marker] for marker in END_MARKER_TOKENS if marker in vocab)
+    return ids
+
+
+def build_logits_processors(model, do_sample: bool, temperature: float, repetition_penalty: float):
+    """Same processors `model.generate` would apply for these sampling parameters."""
+    from transformers import (LogitsProcessorList, RepetitionPenaltyLogitsProcessor,
+                              TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+
+    processors = LogitsProcessorList()
+    if repetition_penalty and repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if do_sample:
+        config = model.generation_config
+        if temperature and temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        top_k = config.top_k if config.top_k is not None else 50
+        if top_k:
+            processors.append(TopKLogitsWarper(top_k))
+        if config.top_p is not None and config.top_p < 1.0:
+            processors.append(TopPLogitsWarper(config.top_p))
+    return processors
+
+
+def select_next_tokens(processors, sequences, logits, do_sample: bool):
+    import torch
+
+    scores = processors(sequences, logits.float())
+    if do_sample:
+        return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+    return torch.argmax(scores, dim=-1)
+
+
+def select_cache_rows(cache, rows):
+    """Keeps only the given batch rows of a KV cache (Cache object or legacy tuples)."""
+    if hasattr(cache, "batch_select_indices"):
+        cache.batch_select_indices(rows)
+        return cache
+    return tuple(tuple(t[rows] for t in layer) for layer in cache)
+
+
+def expand_cache(cache, batch: int):
+    """Copies a batch-1 KV cache into `batch` rows, leaving the original untouched for reuse."""
+    if hasattr(cache, "batch_repeat_interleave"):
+        cache = copy.deepcopy(cache)
+        cache.batch_repeat_interleave(batch)
+        return cache
+    return tuple(tuple(t.repeat_interleave(batch, dim=0) for t in layer) for layer in cache)
+
+
+def prefill_prefix(model, tokenizer, prefix: str):
+    """Runs the shared prefix through the model once; returns (prefix_ids, kv_cache)."""
+    import torch
+
+    prefix_ids = torch.tensor([tokenizer(prefix).input_ids], dtype=torch.long, device=model.device)
+    with torch.inference_mode():
+        out = model(input_ids=prefix_ids, use_cache=True)
+    return prefix_ids, out.past_key_values
+
+
+def cache_length(cache) -> int:
+    if hasattr(cache, "get_seq_length"):
+        return cache.get_seq_length()
+    return cache[0][0].shape[2]
+
+
+def crop_cache(cache, length: int):
+    """Drops cached positions from `length` on (rejected speculative tokens)."""
+    if hasattr(cache, "crop"):
+        cache.crop(length)
+        return cache
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in cache)
+
+
+def left_pad(token_lists: List[List[int]], pad_id: int, device):
+    import torch
+
+    width = max(len(t) for t in token_lists)
+    input_ids = torch.full((len(token_lists), width), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_lists), width), dtype=torch.long)
+    for row, tokens in enumerate(token_lists):
+        input_ids[row, width - len(tokens):] = torch.tensor(tokens, dtype=torch.long)
+        attention_mask[row, width - len(tokens):] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+
+def decode_batch(model, token_lists: List[List[int]], max_new_tokens: Union[int, List[int]], processors,
+                 do_sample: bool, eos_ids: set, pad_id: int, prefix=None,
+                 stop_rules: Optional[List[Optional[list]]] = None,
+                 decode: Optional[Callable[[List[int]], str]] = None) -> List[List[int]]:
+    """
+    One left-padded decode loop; finished rows are removed from the batch and KV cache.
+    With `prefix` (from `prefill_prefix`) only the per-row suffixes are prefilled:
+    rows look like [prefix][pads][suffix] and the pads are masked out.
+    `max_new_tokens` may be given per row, and so may stopping rules (stopping.py).
+    """
+    import torch
+
+    limits = max_new_tokens if isinstance(max_new_tokens, list) else [max_new_tokens] * len(token_lists)
+
+    input_ids, attention_mask = left_pad(token_lists, pad_id, model.device)
+    sequences, cache = input_ids, None
+    if prefix is not None:
+        prefix_ids, prefix_cache = prefix
+        prefix_rows = prefix_ids.expand(len(token_lists), -1)
+        cache = expand_cache(prefix_cache, len(token_lists))
+        sequences = torch.cat([prefix_rows, input_ids], dim=-1)
+        attention_mask = torch.cat([torch.ones_like(prefix_rows), attention_mask], dim=-1)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+    out = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                past_key_values=cache, use_cache=True)
+    cache, logits = out.past_key_values, out.logits[:, -1, :]
+
+    active = list(range(len(token_lists)))  # batch row -> original index
+    generated: List[List[int]] = [[] for _ in token_lists]
+
+    for _ in range(max(limits)):
+        next_tokens = select_next_tokens(processors, sequences, logits, do_sample)
+        keep = []
+        for row, index in enumerate(active):
+            token = int(next_tokens[row])
+            if token in eos_ids:
+                continue
+            generated[index].append(token)
+            if stop_rules and stop_rules[index]:
+                cut = check_rules(stop_rules[index], generated[index], decode)
+                if cut is not None:
+                    generated[index] = generated[index][:cut]
+                    continue
+            if len(generated[index]) < limits[index]:
+                keep.append(row)
+        if not keep:
+            break
+        if len(keep) < len(active):
+            rows = torch.tensor(keep, device=sequences.device)
+            cache = select_cache_rows(cache, rows)
+            sequences, attention_mask, next_tokens = sequences[rows], attention_mask[rows], next_tokens[rows]
+            active = [active[row] for row in keep]
+
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1)
+        position_ids = attention_mask.sum(-1, keepdim=True) - 1
+        out = model(input_ids=next_tokens[:, None], attention_mask=attention_mask,
+                    position_ids=position_ids, past_key_values=cache, use_cache=True)
+        cache, logits = out.past_key_values, out.logits[:, -1, :]
+
+    return generated
+
+
+# --- Assisted decoding ---
+
+class PromptLookup:
+    """Proposes the tokens that followed the most recent earlier occurrence of the current n-gram."""
+
+    def __init__(self, max_ngram: int = 3, num_tokens: int = 10):
+        self.max_ngram = max_ngram
+        self.num_tokens = num_tokens
+
+    def reset(self):
+        pass
+
+    def __call__(self, tokens: List[int]) -> List[int]:
+        for n in range(min(self.max_ngram, len(tokens) - 1), 0, -1):
+            tail = tokens[-n:]
+            for start in range(len(tokens) - n - 1, -1, -1):
+                if tokens[start:start + n] == tail:
+                    return tokens[start + n:start + n + self.num_tokens]
+        return []
+
+
+class DraftModel:
+    """Proposes greedy continuations from a small model that shares the main model's tokenizer."""
+
+    def __init__(self, model, num_tokens: int = 5):
+        self.model = model
+        self.num_tokens = num_tokens
+        self.reset()
+
+    def reset(self):
+        self._cache = None
+        self._seen: List[int] = []  # ids covered by the draft KV cache
+
+    def __call__(self, tokens: List[int]) -> List[int]:
+        import torch
+
+        # Reuse the cache up to the first rejected proposal; always re-feed the last token.
+        common = 0
+        for a, b in zip(self._seen, tokens):
+            if a != b:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)
+        if self._cache is not None:
+            self._cache = crop_cache(self._cache, common)
+        self._seen = list(tokens)
+        feed = tokens[common:]
+        proposals: List[int] = []
+        with torch.inference_mode():
+            for _ in range(self.num_tokens):
+                out = self.model(input_ids=torch.tensor([feed], device=self.model.device),
+                                 past_key_values=self._cache, use_cache=True)
+                self._cache = out.past_key_values
+                token = int(out.logits[0, -1].argmax())
+                proposals.append(token)
+                self._seen.append(token)
+                feed = [token]
+        # The last proposal was never fed to the draft model.
+        self._seen.pop()
+        return proposals
+
+
+_compatible_tokenizers: Dict[tuple, bool] = {}
+
+
+def tokenizers_compatible(tokenizer, draft_tokenizer) -> bool:
+    """A draft model can only propose ids the main model reads the same way."""
+    key = (tokenizer.name_or_path, draft_tokenizer.name_or_path)
+    if key not in _compatible_tokenizers:
+        _compatible_tokenizers[key] = (tokenizer.get_vocab() == draft_tokenizer.get_vocab()
+                                       and tokenizer.eos_token_id == draft_tokenizer.eos_token_id)
+    return _compatible_tokenizers[key]
+
+
+def new_assist_stats() -> Dict[str, int]:
+    return {"rows": 0, "verify_steps": 0, "drafted": 0, "accepted": 0, "generated": 0}
+
+
+def summarize_assist_stats(stats: Dict[str, int]) -> Dict:
+    return {
+        **stats,
+        "acceptance_rate": round(stats["accepted"] / stats["drafted"], 3) if stats["drafted"] else 0.0,
+        # Tokens produced per main-model forward pass (1.0 == plain decoding).
+        "tokens_per_step": round(stats["generated"] / stats["verify_steps"], 2) if stats["verify_steps"] else 0.0,
+    }
+
+
+def decode_assisted(model, token_ids: List[int], max_new_tokens: int, processors, do_sample: bool,
+                    eos_ids: set, assistant, prefix=None, stats: Optional[Dict[str, int]] = None,
+                    on_tokens: Optional[Callable[[List[int]], None]] = None,
+                    should_stop: Optional[Callable[[], bool]] = None,
+                    stop_rules: Optional[list] = None,
+                    decode: Optional[Callable[[List[int]], str]] = None) -> List[int]:
+    """
+    Speculative decoding for one row. Each step the assistant proposes candidates, the
+    model scores them in one pass, and tokens are taken position by position (with the
+    same processors / sampling as plain decoding) for as long as they match the candidates.
+    """
+    import torch
+
+    device = model.device
+    if prefix is not None:
+        prefix_ids, prefix_cache = prefix
+        cache = expand_cache(prefix_cache, 1)
+        context = prefix_ids[0].tolist() + list(token_ids)
+        cached = cache_length(cache)
+    else:
+        cache, context, cached = None, list(token_ids), 0
+    assistant.reset()
+    generated: List[int] = []
+    if stats is not None:
+        stats["rows"] += 1
+
+    while len(generated) < max_new_tokens and not (should_stop and should_stop()):
+        # Room for the candidates plus the token the model picks after them.
+        candidates = assistant(context)[:max(0, max_new_tokens - len(generated) - 1)]
+        out = model(input_ids=torch.tensor([context[cached:] + candidates], device=device),
+                    past_key_values=cache, use_cache=True)
+        cache = out.past_key_values
+        logits = out.logits[0, -(len(candidates) + 1):, :]
+
+        sequence = torch.tensor([context], dtype=torch.long, device=device)
+        accepted, new_tokens = 0, []
+        for j in range(len(candidates) + 1):
+            token = int(select_next_tokens(processors, sequence, logits[j:j + 1], do_sample)[0])
+            new_tokens.append(token)
+            if j == len(candidates) or token != candidates[j] or token in eos_ids:
+                break
+            accepted += 1
+            sequence = torch.cat([sequence, sequence.new_tensor([[token]])], dim=-1)
+
+        if stats is not None:
+            stats["verify_steps"] += 1
+            stats["drafted"] += len(candidates)
+            stats["accepted"] += accepted
+
+        # Only the accepted candidates are valid cache entries; the last picked token is fed next step.
+        cached = len(context) + accepted
+        cache = crop_cache(cache, cached)
+        finished = False
+        emitted = []
+        for token in new_tokens:
+            if token in eos_ids:
+                finished = True
+                break
+            emitted.append(token)
+            if stop_rules:
+                cut = check_rules(stop_rules, generated + emitted, decode)
+                if cut is not None:
+                    emitted = emitted[:max(0, cut - len(generated))]
+                    finished = True
+                    break
+            if len(generated) + len(emitted) >= max_new_tokens:
+                break
+        generated.extend(emitted)
+        context.extend(emitted)
+        if stats is not None:
+            stats["generated"] += len(emitted)
+        if on_tokens and emitted:
+            on_tokens(emitted)
+        if finished:
+            break
+
+    return generated
+
+
+def generate_batched(model, tokenizer, prompts: Dict[Hashable, str],
+                     max_new_tokens: Union[int, Dict[Hashable, int]], *,
+                     batch_size: int = 4, do_sample: bool = False, temperature: float = 1.0,
+                     repetition_penalty: float = 1.0, prefix: Optional[str] = None,
+                     prefix_cache: Optional[Dict] = None,
+                     on_result: Optional[Callable[[Hashable, str], None]] = None,
+                     assistant=None, assist_stats: Optional[Dict[str, int]] = None,
+                     stop_rules: Optional[Dict[Hashable, list]] = None,
+                     lengths: Optional[Dict[Hashable, int]] = None) -> Dict[Hashable, str]:
+    """
+    Generates a completion for every prompt (keyed, e.g. by heading) using length-bucketed
+    batches. Returns only the newly generated text per key.
+    If `prefix` is given, `prompts` hold only the per-key suffixes; the prefix is
+    prefilled once and its KV cache is cloned into every batch. Passing the same
+    `prefix_cache` dict across calls reuses that prefill between calls too.
+    With an `assistant` (PromptLookup / DraftModel) every prompt is decoded on its own
+    with assisted decoding instead; acceptance counters are added to `assist_stats`.
+    `max_new_tokens` and `stop_rules` may be given per key; `lengths` receives the
+    number of tokens generated per key.
+    """
+    import torch
+
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    if prefix is None:
+        token_lists = {key: tokenizer(prompt).input_ids for key, prompt in prompts.items()}
+    else:
+        token_lists = {key: tokenizer(prompt, add_special_tokens=False).input_ids for key, prompt in prompts.items()}
+    processors = build_logits_processors(model, do_sample, temperature, repetition_penalty)
+    eos_ids = eos_token_ids(model, tokenizer)
+    limits = max_new_tokens if isinstance(max_new_tokens, dict) else {key: max_new_tokens for key in prompts}
+    stop_rules = stop_rules or {}
+    decode = lambda ids: tokenizer.decode(ids, skip_special_tokens=True)
+
+    results: Dict[Hashable, str] = {}
+
+    def finish(key, tokens: List[int]):
+        results[key] = finalize_text(stop_rules.get(key) or [], decode(tokens))
+        if lengths is not None:
+            lengths[key] = len(tokens)
+        if on_result:
+            on_result(key, results[key])
+
+    with torch.inference_mode():
+        prefilled = None
+        if prefix is not None:
+            prefilled = prefix_cache.get(prefix) if prefix_cache is not None else None
+            if prefilled is None:
+                prefilled = prefill_prefix(model, tokenizer, prefix)
+                if prefix_cache is not None:
+                    prefix_cache[prefix] = prefilled
+        if assistant is not None:
+            for key, tokens in token_lists.items():
+                finish(key, decode_assisted(model, tokens, limits[key], processors, do_sample, eos_ids,
+                                            assistant, prefix=prefilled, stats=assist_stats,
+                                            stop_rules=stop_rules.get(key), decode=decode))
+            return results
+        for bucket in length_buckets({k: len(v) for k, v in token_lists.items()}, batch_size):
+            outputs = decode_batch(model, [token_lists[k] for k in bucket], [limits[k] for k in bucket],
+                                   processors, do_sample, eos_ids, pad_id, prefix=prefilled,
+                                   stop_rules=[stop_rules.get(k) for k in bucket], decode=decode)
+            for key, tokens in zip(bucket, outputs):
+                finish(key, tokens)
+    return results
@@ -0,0 +1,142 @@
+# history.py
+"""
+Token-budgeted chat history.
+
+The most recent turns are sent verbatim as long as they fit a token budget (counted
+with the chat model's real tokenizer). Older turns are folded into a rolling summary
+that is cached by the exact turns it covers, so it is only extended when more turns
+fall out of the window. Turns are dropped in fixed-size chunks: between two shifts the
+prompt keeps the same prefix, which keeps per-session KV caches (sessions.py) valid.
+"""
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+# --- CONFIGURATION ---
+# Tokens of history (incl. the new message) sent verbatim; 0 sends the whole history.
+CHAT_HISTORY_TOKENS = int(os.environ.get("COGNISIGHT_CHAT_HISTORY_TOKENS", "1536"))
+# Messages that leave the window together (and are summarized together).
+CHAT_HISTORY_DROP_CHUNK = int(os.environ.get("COGNISIGHT_CHAT_HISTORY_DROP_CHUNK", "4"))
+# Max tokens of the rolling summary.
+CHAT_SUMMARY_TOKENS = 120
+# Cached summaries (one per summarized prefix of a conversation).
+CHAT_SUMMARY_CACHE_ENTRIES = 256
+# Chat-template tokens around each message (<start_of_turn>role ... <end_of_turn>).
+TURN_OVERHEAD_TOKENS = 5
+# Characters of each old message shown to the summarizer.
+SUMMARY_MESSAGE_CHARS = 400
+
+
+class HistoryManager:
+    def __init__(self, tokenizer_fn: Callable, summarize_fn: Callable[[str], str],
+                 budget: int = CHAT_HISTORY_TOKENS, drop_chunk: int = CHAT_HISTORY_DROP_CHUNK):
+        # tokenizer_fn() -> the chat model's tokenizer; summarize_fn(prompt) -> summary text.
+        self.tokenizer_fn = tokenizer_fn
+        self.summarize_fn = summarize_fn
+        self.budget = budget
+        self.drop_chunk = max(1, drop_chunk)
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self.summary_hits = 0
+        self.summary_updates = 0
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer_fn()(text, add_special_tokens=False).input_ids)
+
+    def fit(self, conversation: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], Dict]:
+        """
+        `conversation` alternates user/assistant and ends with the new user message.
+        Returns the conversation to send and a report of what was kept.
+        """
+        counts = [self.count_tokens(m["content"]) + TURN_OVERHEAD_TOKENS for m in conversation]
+        history, current = conversation[:-1], conversation[-1]
+        dropped = 0
+        if self.budget > 0:
+            remaining = self.budget - counts[-1]
+            keep_from = len(history)
+            while keep_from > 0 and counts[keep_from - 1] <= remaining:
+                remaining -= counts[keep_from - 1]
+                keep_from -= 1
+            if keep_from:
+                dropped = min(len(history), math.ceil(keep_from / self.drop_chunk) * self.drop_chunk)
+            # The chat template expects the window to open with a user turn.
+            while dropped < len(history) and history[dropped]["role"] != "user":
+                dropped += 1
+
+        summary, cache_state = self._summary(history[:dropped])
+        kept = [dict(m) for m in history[dropped:]] + [dict(current)]
+        summary_tokens = 0
+        if summary:
+            # Gemma has no system role, so the summary leads the first kept user turn.
+            kept[0]["content"] = f"(Summary of the earlier conversation: {summary})\n\n{kept[0]['content']}"
+            summary_tokens = self.count_tokens(summary)
+        return kept, {
+            "history_messages": len(history),
+            "kept_messages": len(kept) - 1,
+            "summarized_messages": dropped,
+            "summary_tokens": summary_tokens,
+            "summary_cache": cache_state,
+            "history_tokens": sum(counts[dropped:]) + summary_tokens,
+        }
+
+    # --- Rolling summary ---
+
+    @staticmethod
+    def _prefix_keys(turns: List[Dict[str, str]]) -> List[str]:
+        """keys[i] identifies turns[:i + 1]."""
+        digest = hashlib.sha1()
+        keys = []
+        for turn in turns:
+            digest.update(f"{turn['role']}\x00{turn['content']}\x00".encode("utf-8"))
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _summary(self, turns: List[Dict[str, str]]) -> Tuple[str, str]:
+        if not turns:
+            return "", "none"
+        keys = self._prefix_keys(turns)
+        # Longest already-summarized prefix of the dropped turns.
+        start, summary = 0, ""
+        with self._lock:
+            for i in range(len(keys), 0, -1):
+                if keys[i - 1] in self._summaries:
+                    start, summary = i, self._summaries[keys[i - 1]]
+                    self._summaries.move_to_end(keys[i - 1])
+                    break
+        if start == len(turns):
+            self.summary_hits += 1
+            return summary, "hit"
+        for chunk_start in range(start, len(turns), self.drop_chunk):
+            chunk_end = min(len(turns), chunk_start + self.drop_chunk)
+            summary = self.summarize_fn(self._summary_prompt(summary, turns[chunk_start:chunk_end])).strip()
+            self.summary_updates += 1
+            with self._lock:
+                self._summaries[keys[chunk_end - 1]] = summary
+                while len(self._summaries) > CHAT_SUMMARY_CACHE_ENTRIES:
+                    self._summaries.popitem(last=False)
+        return summary, "updated"
+
+    @staticmethod
+    def _summary_prompt(summary: str, turns: List[Dict[str, str]]) -> str:
+        lines = [f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['content'][:SUMMARY_MESSAGE_CHARS]}" for t in turns]
+        return (
+            "Summarize this conversation between a user and an assistant in a few sentences. "
+            "Keep names, files, code identifiers and decisions.\n"
+            + (f"Earlier summary: {summary}\n" if summary else "")
+            + "\n".join(lines)
+        )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            cached = len(self._summaries)
+        return {
+            "budget_tokens": self.budget,
+            "drop_chunk": self.drop_chunk,
+            "cached_summaries": cached,
+            "summary_hits": self.summary_hits,
+            "summary_updates": self.summary_updates,
+        }
@@ -0,0 +1,174 @@
+# inference.py
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# --- CONFIGURATION ---
+# Threads in the dedicated inference executor (request-path model calls).
+INFERENCE_WORKERS = int(os.environ.get("COGNISIGHT_INFERENCE_WORKERS", "2"))
+# Concurrent calls allowed on one model (chat + doc stages share these slots).
+MODEL_CONCURRENCY = int(os.environ.get("COGNISIGHT_MODEL_CONCURRENCY", "2"))
+# Requests allowed to wait for a model slot before new ones are rejected with 429.
+MODEL_MAX_WAITING = int(os.environ.get("COGNISIGHT_MODEL_MAX_WAITING", "8"))
+# Threads that may run torch concurrently: inference executor + documentation job workers.
+CONCURRENT_TORCH_WORKERS = INFERENCE_WORKERS + int(os.environ.get("COGNISIGHT_DOC_WORKERS", "1"))
+
+
+class OverloadedError(Exception):
+    def __init__(self, model_id: str, retry_after: int):
+        super().__init__(f"Too many pending requests for {model_id}; retry in {retry_after}s.")
+        self.model_id = model_id
+        self.retry_after = retry_after
+
+
+def available_cores() -> int:
+    """Cores this process may run on (its affinity set, e.g. a pinned model worker's cores)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def torch_threads_per_worker() -> int:
+    """Splits the cores between concurrent torch workers so they don't oversubscribe."""
+    return max(1, available_cores() // max(1, CONCURRENT_TORCH_WORKERS))
+
+
+def init_inference_thread():
+    """
+    Thread initializer for every thread that runs torch ops. With OpenMP builds the
+    intra-op team size is a per-thread setting, so each worker gets its own share.
+    """
+    import torch
+    torch.set_num_threads(torch_threads_per_worker())
+
+
+class _Ticket:
+    """An admitted request: holds its place in the wait queue until it takes a model slot."""
+
+    def __init__(self, gate: "InferenceGate", model_id: str):
+        self.gate = gate
+        self.model_id = model_id
+        self._released = False
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        self.gate._slot(self.model_id).acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.gate._slot(self.model_id).release()
+        self.gate._record(self.model_id, time.perf_counter() - self._started)
+        self.release()
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.gate._leave(self.model_id)
+
+
+class InferenceGate:
+    """
+    Dedicated executor + per-model concurrency semaphores + bounded wait queues.
+    Async handlers `await gate.run(model_id, fn, ...)` instead of calling the model inline.
+    """
+
+    def __init__(self, workers: int = INFERENCE_WORKERS, per_model: int = MODEL_CONCURRENCY,
+                 max_waiting: int = MODEL_MAX_WAITING):
+        self.workers = workers
+        self.per_model = per_model
+        self.max_waiting = max_waiting
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._pending: Dict[str, int] = {}
+        self._avg_s: Dict[str, float] = {}
+        self.rejected = 0
+
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference",
+                                                    initializer=init_inference_thread)
+            return self._executor
+
+    def _slot(self, model_id: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._slots.setdefault(model_id, threading.BoundedSemaphore(self.per_model))
+
+    def _leave(self, model_id: str):
+        with self._lock:
+            self._pending[model_id] -= 1
+
+    def _record(self, model_id: str, seconds: float):
+        with self._lock:
+            previous = self._avg_s.get(model_id)
+            self._avg_s[model_id] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    def admit(self, model_id: str) -> _Ticket:
+        """Reserves a place for one call, or raises OverloadedError if the wait queue is full."""
+        with self._lock:
+            pending = self._pending.get(model_id, 0)
+            if pending >= self.per_model + self.max_waiting:
+                self.rejected += 1
+                waves = math.ceil((pending - self.per_model + 1) / self.per_model)
+                raise OverloadedError(model_id, max(1, math.ceil(self._avg_s.get(model_id, 10.0) * waves)))
+            self._pending[model_id] = pending + 1
+        return _Ticket(self, model_id)
+
+    async def run(self, model_id: str, fn: Callable, *args):
+        ticket = self.admit(model_id)
+
+        def _call():
+            with ticket:
+                return fn(*args)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor(), _call)
+        finally:
+            ticket.release()  # no-op unless the call never started
+
+    def call(self, model_id: str, fn: Callable, *args):
+        """
+        Blocking counterpart of run() for request-path work that starts on another thread
+        (e.g. a history summary inside a chat request): same admission, same executor.
+        Must not be called from the executor's own threads.
+        """
+        ticket = self.admit(model_id)
+
+        def _call():
+            with ticket:
+                return fn(*args)
+
+        try:
+            return self.executor().submit(_call).result()
+        finally:
+            ticket.release()
+
+    @contextmanager
+    def hold(self, model_id: str):
+        """Model slot for background work (doc stages): waits, but is never rejected."""
+        with self._lock:
+            self._pending[model_id] = self._pending.get(model_id, 0) + 1
+        with _Ticket(self, model_id):
+            yield
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "torch_threads_per_worker": torch_threads_per_worker(),
+                "per_model_concurrency": self.per_model,
+                "max_waiting": self.max_waiting,
+                "pending": dict(self._pending),
+                "avg_call_s": {m: round(s, 2) for m, s in self._avg_s.items()},
+                "rejected": self.rejected,
+            }
+
+
+# Process-wide gate shared by every endpoint that touches a model.
+inference_gate = InferenceGate()
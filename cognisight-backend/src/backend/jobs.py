@@ -0,0 +1,208 @@
+# jobs.py
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+# --- CONFIGURATION ---
+# Documentation jobs executed concurrently (each one holds up to three models).
+DOC_WORKERS = int(os.environ.get("COGNISIGHT_DOC_WORKERS", "1"))
+# Jobs allowed to wait for a worker before submissions are rejected.
+DOC_QUEUE_SIZE = int(os.environ.get("COGNISIGHT_DOC_QUEUE_SIZE", "16"))
+# Finished jobs kept in memory for status/result lookups.
+DOC_JOB_RETENTION = int(os.environ.get("COGNISIGHT_DOC_JOB_RETENTION", "100"))
+
+# Events that complete one heading in a given stage.
+_HEADING_EVENTS = {"summary": 1, "draft": 2, "section": 3}
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class DocJob:
+    def __init__(self, context_data: Dict[str, str], headings: List[str], project_name: str, domain: str,
+                 listener: Optional[Callable[[Dict], None]] = None, options: Optional[Dict] = None):
+        self.id = uuid.uuid4().hex
+        self.context_data = context_data
+        self.headings = headings
+        self.project_name = project_name
+        self.domain = domain
+        self.listener = listener
+        self.options = options or {}  # extra keyword arguments for the runner
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.current_stage: Optional[int] = None
+        self.stages: Dict[int, Dict] = {}
+        self.result: Optional[Dict[str, str]] = None
+        self.error: Optional[str] = None
+        # A stage failed and fell back to placeholder text; such results are never cached.
+        self.degraded = False
+        self.cached = False
+        # Work taken from earlier runs: "files" (manifest report) and cached headings per stage.
+        self.reuse: Dict = {"stages": {}}
+        self.future: Future = Future()
+
+    def handle_event(self, event: Dict):
+        """Progress callback handed to SequentialGenerator."""
+        kind = event.get("event")
+        if kind == "stage_start":
+            self.current_stage = event["stage"]
+            self.stages[event["stage"]] = {"name": event["name"], "status": "running",
+                                           "completed": 0, "total": len(self.headings)}
+        elif kind == "stage_end":
+            self.stages[event["stage"]].update(status="done", elapsed_s=event.get("elapsed_s"))
+        elif kind == "stage_error":
+            self.degraded = True
+        elif kind in _HEADING_EVENTS and _HEADING_EVENTS[kind] in self.stages:
+            self.stages[_HEADING_EVENTS[kind]]["completed"] += 1
+            if event.get("cached"):
+                stage = _HEADING_EVENTS[kind]
+                self.reuse["stages"][stage] = self.reuse["stages"].get(stage, 0) + 1
+        if self.listener:
+            self.listener(event)
+
+    def wait_s(self) -> float:
+        return (self.started_at or time.time()) - self.submitted_at
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "project_name": self.project_name,
+            "headings": len(self.headings),
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_s": round(self.wait_s(), 2),
+            "run_s": round((self.finished_at or time.time()) - self.started_at, 2) if self.started_at else None,
+            "current_stage": self.current_stage,
+            "stages": self.stages,
+            "cached": self.cached,
+            "degraded": self.degraded,
+            "reuse": self.reuse,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Bounded queue + fixed pool of worker threads for documentation jobs, so the
+    blocking pipeline never runs on the uvicorn event loop.
+    """
+
+    def __init__(self, runner: Callable, workers: int = DOC_WORKERS, max_queue: int = DOC_QUEUE_SIZE,
+                 retention: int = DOC_JOB_RETENTION, initializer: Optional[Callable[[], None]] = None):
+        # runner(context_data, headings, on_event, **options) -> sections
+        self.runner = runner
+        # Called once in each worker thread before it takes jobs (e.g. torch thread settings).
+        self.initializer = initializer
+        self.workers = workers
+        self.retention = retention
+        self._queue: "queue.Queue[DocJob]" = queue.Queue(maxsize=max_queue)
+        self._jobs: "OrderedDict[str, DocJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._wait_times: List[float] = []
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"doc-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, context_data: Dict[str, str], headings: List[str], project_name: str, domain: str,
+               listener: Optional[Callable[[Dict], None]] = None, options: Optional[Dict] = None) -> DocJob:
+        self.start()
+        job = DocJob(context_data, headings, project_name, domain, listener, options)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Documentation queue is full ({self._queue.maxsize} jobs waiting).")
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        print(f"--- Queued doc job {job.id} ({project_name}), queue depth {self._queue.qsize()} ---")
+        return job
+
+    def add_finished(self, headings: List[str], project_name: str, domain: str, result: Dict[str, str]) -> DocJob:
+        """Registers a job answered without running the pipeline (e.g. from the result cache)."""
+        job = DocJob({}, headings, project_name, domain)
+        job.status = "done"
+        job.cached = True
+        job.reuse["stages"] = {stage: len(headings) for stage in _HEADING_EVENTS.values()}
+        job.started_at = job.finished_at = job.submitted_at
+        job.result = result
+        job.future.set_result(result)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def _worker(self):
+        if self.initializer:
+            self.initializer()
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            with self._lock:
+                self._wait_times = (self._wait_times + [job.wait_s()])[-50:]
+            try:
+                job.result = self.runner(job.context_data, job.headings, job.handle_event, **job.options)
+                job.status = "done"
+                job.future.set_result(job.result)
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                job.status = "failed"
+                job.error = str(e)
+                job.future.set_exception(e)
+            finally:
+                job.finished_at = time.time()
+                job.context_data = {}  # context can be large; the result is all we need now
+                self._queue.task_done()
+
+    def _prune(self):
+        finished = [jid for jid, j in self._jobs.items() if j.status in ("done", "failed")]
+        for jid in finished[:max(0, len(finished) - self.retention)]:
+            del self._jobs[jid]
+
+    def get(self, job_id: str) -> Optional[DocJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job: DocJob) -> Optional[int]:
+        """1-based place in the wait queue, or None once the job has started."""
+        if job.status != "queued":
+            return None
+        with self._lock:
+            queued = [j for j in self._jobs.values() if j.status == "queued"]
+        return queued.index(job) + 1 if job in queued else None
+
+    def list(self, status: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [j.to_dict() for j in jobs if status is None or j.status == status]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            recent_waits = list(self._wait_times)
+        queued = [j for j in jobs if j.status == "queued"]
+        return {
+            "workers": self.workers,
+            "queue_depth": len(queued),
+            "queue_capacity": self._queue.maxsize,
+            "running": sum(1 for j in jobs if j.status == "running"),
+            "oldest_wait_s": round(max((j.wait_s() for j in queued), default=0.0), 2),
+            "avg_wait_s": round(sum(recent_waits) / len(recent_waits), 2) if recent_waits else 0.0,
+        }
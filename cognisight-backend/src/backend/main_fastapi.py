@@ -1,316 +1,519 @@
 # main_fastapi.py
 import uvicorn
-import io
+import asyncio
+import hashlib
+import json
 import os
-import zipfile
-import gc
-import torch
+import queue
+import tempfile
+import threading
+import time
 import re
-from typing import List, Dict
+from contextlib import asynccontextmanager, nullcontext
+from typing import Callable, List, Dict, Optional
 from pydantic import BaseModel
 # FastAPI Imports
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-# Document Processing Imports
-from pypdf import PdfReader
-from docx import Document
+# NOTE: torch, transformers, pypdf and python-docx are imported lazily inside the
+# functions that need them, so the server binds quickly and /extract-headings never
+# pays for the ML stack.
 
 # AI Model Imports
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoModelForCausalLM
-
-# --- CONFIGURATION & HARDWARE CHECK ---
+from model_manager import model_pool, configured_warmup_models, load_tokenizer, model_fingerprint
+from doc_cache import content_key, doc_cache, stage_cache, template_cache, text_hash
+from history import CHAT_SUMMARY_TOKENS, HistoryManager
+from code_context import ZipLimitError, parse_code_context
+from manifests import ProjectManifest, manifest_store
+from jobs import DocJob, JobManager, QueueFullError
+from inference import OverloadedError, inference_gate, init_inference_thread
+from scheduler import CHAT_CONTINUOUS_BATCHING
+from sessions import chat_sessions
+from stopping import LengthStats, MarkerStop, RepetitionStop, SectionsStop, section_titles
+from pools import shutdown_parse_pool
+from templates import TEMPLATE_MAX_HEADINGS, extract_headings as extract_template_headings
+from workers import chat_batcher, run_model_task, submit_model_task, worker_pool
+
+# --- CONFIGURATION ---
 PORT = 8000
 HOST = "0.0.0.0"
 
-# 1. Determine Device
-if torch.cuda.is_available():
-    DEVICE = "cuda"
-    GPU_NAME = torch.cuda.get_device_name(0)
-    print(f"\n{'='*40}")
-    print(f"✅ HARDWARE ACCELERATION ENABLED")
-    print(f"🚀 DEVICE: {DEVICE.upper()} ({GPU_NAME})")
-    print(f"{'='*40}\n")
-    # Optional: Enable CUDNN benchmark for slight speedup on fixed input sizes
-    torch.backends.cudnn.benchmark = True
-else:
-    DEVICE = "cpu"
-    print(f"\n{'='*40}")
-    print(f"⚠️  NO GPU DETECTED - RUNNING ON CPU")
-    print(f"🐢 Expect significantly slower generation times.")
-    print(f"{'='*40}\n")
+# Max headings Stage 1 (Flan-T5) summarizes in one padded batch.
+STAGE1_BATCH_SIZE = int(os.environ.get("COGNISIGHT_STAGE1_BATCH_SIZE", "16"))
+# Max headings decoded together in Stages 2/3 (TinyLlama / Gemma), per length bucket.
+DECODE_BATCH_SIZE = int(os.environ.get("COGNISIGHT_DECODE_BATCH_SIZE", "4"))
+# Upper token limits for Stages 2/3; the per-heading limit adapts below these (see stopping.py).
+STAGE2_MAX_NEW_TOKENS = 512
+STAGE3_MAX_NEW_TOKENS = 600
+# Stage 2 must produce exactly these top-level sections (see _stage_2_suffix).
+STAGE2_SECTIONS = ["Overview", "Key Capabilities", "Technical Implementation"]
+# Plain-text turn markers the stage models emit when they run on into another turn.
+STAGE_TURN_MARKERS = ["<|user|>", "<|system|>", "<|end|>", "<|assistant|>", "\nUser:"]
+
+# Seconds without progress before the streaming /generate-doc mode sends a heartbeat line.
+STREAM_HEARTBEAT_S = 15.0
+# Retry-After hint (seconds) for full queues and unfinished job results.
+JOB_RETRY_AFTER_S = 30
+
+# Documentation pipeline: "auto" overlaps stages when all three models fit the RAM budget,
+# otherwise runs them strictly one after another. Force with "pipelined" / "sequential".
+PIPELINE_MODE = os.environ.get("COGNISIGHT_PIPELINE_MODE", "auto")
+# Headings allowed to wait between two pipelined stages.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("COGNISIGHT_PIPELINE_QUEUE_SIZE", "4"))
+
+# Chat model + sampling parameters shared by /api/chat and /api/chat/stream.
+CHAT_MODEL_ID = "models/gemma-2b-it"
+CHAT_GENERATION_KWARGS = {
+    "max_new_tokens": 1024, # High limit for full responses
+    "do_sample": True,
+    "temperature": 0.7,
+    "repetition_penalty": 1.1,
+}
+# End-of-turn tokens already stop generation; these catch loops and turns written as text.
+CHAT_STOP_RULES = [RepetitionStop(), MarkerStop(["<|user|>", "\nUser:"])]
+
+# Small seq2seq model that folds chat turns leaving the history window into a rolling summary.
+CHAT_SUMMARY_MODEL_ID = "models/flan-t5-base"
+
+# Assisted (speculative) decoding: "prompt_lookup", or "draft:<model path>" for a small model
+# sharing the main model's tokenizer. Off by default. Stage 3 mostly copies its draft and chat
+# replies often quote the history, so prompt lookup accepts many tokens there.
+STAGE3_ASSIST = os.environ.get("COGNISIGHT_STAGE3_ASSIST", "")
+CHAT_ASSIST = os.environ.get("COGNISIGHT_CHAT_ASSIST", "")
+# Assisted chat decodes each request on its own instead of joining the continuous batch.
+CHAT_BATCHED = CHAT_CONTINUOUS_BATCHING and not CHAT_ASSIST
+
+# Uploads are read in chunks of this size instead of all at once.
+UPLOAD_CHUNK_BYTES = 1 << 20
+# Largest accepted upload; archive contents are limited in code_context.py.
+UPLOAD_MAX_MB = int(os.environ.get("COGNISIGHT_UPLOAD_MAX_MB", "200"))
+DEFAULT_HEADINGS = ["1. Introduction", "2. System Architecture", "3. Installation", "4. API Usage", "5. Conclusion"]
 
 class ChatRequest(BaseModel):
     message: str
     history: List[Dict[str, str]] = []
+    # Optional: reuse this conversation's KV cache from the previous turn (see sessions.py).
+    session_id: Optional[str] = None
 # --- UTILITY FUNCTIONS ---
 
-def extract_text_from_file(file_content: bytes, filename: str) -> str:
-    """Extracts text from PDF/DOCX templates."""
-    ext = filename.split('.')[-1].lower()
-    text = ""
-    try:
-        if ext == 'pdf':
-            reader = PdfReader(io.BytesIO(file_content))
-            for page in reader.pages:
-                extracted = page.extract_text()
-                if extracted: text += extracted + "\n"
-        elif ext == 'docx':
-            doc = Document(io.BytesIO(file_content))
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-    except Exception as e:
-        print(f"Error reading template: {e}")
-    return text
-
-def parse_code_context(zip_bytes: bytes) -> Dict[str, str]:
-    """
-    Analyzes zip to extract:
-    1. Structure, 2. Priority Context, 3. General Context, 4. Modules
-    """
-    priority_files = {'package.json', 'requirements.txt', 'README.md', 'Dockerfile', 'docker-compose.yml', 'settings.py', 'config.js', 'pom.xml', 'build.gradle'}
-    ignored_dirs = {'node_modules', '.git', '__pycache__', 'dist', 'build', 'venv', '.idea', '.vscode', 'coverage', 'assets', 'images', 'bin', 'obj'}
-    allowed_exts = {'.py', '.js', '.jsx', '.ts', '.tsx', '.java', '.cpp', '.css', '.html', '.sql', '.json', '.yml', '.md', '.cs'}
-
-    file_structure = []
-    detected_modules = set()
-    priority_content = ""
-    general_content = ""
-
-    regex_python = re.compile(r'^(?:from|import)\s+([a-zA-Z0-9_]+)', re.MULTILINE)
-    regex_js = re.compile(r'(?:require\(|from\s+)[\'"]([@a-zA-Z0-9_\-/]+)[\'"]', re.MULTILINE)
-
+async def spool_upload(upload: UploadFile, suffix: str = "", max_bytes: Optional[int] = None) -> tuple:
+    """Copies an upload to a temporary file in chunks, hashing it on the way. Returns (sha256, path)."""
+    digest = hashlib.sha256()
+    size = 0
+    f = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
-            file_list = sorted(z.infolist(), key=lambda x: x.filename)
-            
-            for file_info in file_list:
-                if file_info.is_dir(): continue
-                
-                path_parts = file_info.filename.split('/')
-                if any(part in ignored_dirs for part in path_parts): continue
-                file_structure.append(file_info.filename)
-                
-                ext = os.path.splitext(file_info.filename)[1].lower()
-                base_name = os.path.basename(file_info.filename)
-                
-                if ext in allowed_exts or base_name in priority_files:
-                    try:
-                        raw = z.read(file_info.filename).decode('utf-8', errors='ignore')
-                        
-                        if len(raw) > 12000 or (len(raw) > 500 and raw.count('\n') < 3): 
-                            continue
-                            
-                        entry = f"\n\n--- FILE: {file_info.filename} ---\n{raw}\n"
-                        
-                        # Module Extraction
-                        if ext == '.py':
-                            detected_modules.update(regex_python.findall(raw))
-                        elif ext in ['.js', '.jsx', '.ts', '.tsx']:
-                            detected_modules.update(regex_js.findall(raw))
-                        
-                        if base_name in priority_files:
-                            priority_content += entry
-                        else:
-                            general_content += entry
-                    except: continue
-                    
-    except Exception as e:
-        print(f"Zip Error: {e}")
-        return {}
-
-    return {
-        "structure": "\n".join(file_structure[:60]),
-        "priority_context": priority_content[:10000],
-        "general_context": general_content[:15000],
-        "modules": ", ".join(list(detected_modules)[:30])
-    }
+        with f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes // 2**20} MB.")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        # Over the limit, client gone (cancelled), disk full...: never leave the partial file behind.
+        os.remove(f.name)
+        raise
+    return digest.hexdigest(), f.name
 
 # --- MODEL ENGINE ---
 
-def cleanup_gpu():
-    """Aggressively clears GPU memory."""
-    if torch.cuda.is_available():
-        gc.collect()
-        torch.cuda.empty_cache()
+# Typical output length per (stage, heading), persisted across restarts.
+length_stats = LengthStats()
 
 class SequentialGenerator:
-    def __init__(self, context_data: Dict[str, str]):
+    STAGES = [
+        (1, "summarization", "run_stage_1_summarization"),
+        (2, "elaboration", "run_stage_2_elaboration"),
+        (3, "polishing", "run_stage_3_polishing"),
+    ]
+
+    MODEL_IDS = ["models/flan-t5-base", "models/tinyllama", "models/gemma-2b-it"]
+
+    # Generation parameters per stage (also part of the result cache key).
+    SAMPLING = {
+        1: {"max_length": 512, "max_new_tokens": 60},
+        2: {"do_sample": True, "temperature": 0.6, "repetition_penalty": 1.15},
+        3: {"do_sample": True, "temperature": 0.5, "repetition_penalty": 1.2},
+    }
+
+    def __init__(self, context_data: Dict[str, str], on_event: Optional[Callable[[Dict], None]] = None,
+                 use_cache: bool = True):
         self.context = context_data
         self.summaries = {}
         self.detailed_docs = {}
         self.final_docs = {}
+        # Per-heading stage outputs are memoized (doc_cache.stage_cache) unless disabled.
+        self.use_cache = use_cache
+        # (stage, heading) pairs holding placeholder text after a stage failure; never cached.
+        self._fallbacks = set()
+        self._fingerprints = {}
+        # Optional progress callback (used by the streaming /generate-doc mode).
+        self.on_event = on_event
+
+    def _emit(self, event: str, **data):
+        if self.on_event:
+            self.on_event({"event": event, **data})
+
+    def run(self, headings: List[str]) -> Dict[str, str]:
+        mode = PIPELINE_MODE
+        if mode not in ("pipelined", "sequential"):
+            # All three models must fit in the RAM budget at once (or live in their own workers) to overlap stages.
+            overlap = worker_pool.covers(self.MODEL_IDS) or model_pool.fits_together(self.MODEL_IDS)
+            mode = "pipelined" if overlap else "sequential"
+        print(f"\n--- Pipeline mode: {mode} ---")
+        if mode == "pipelined" and len(headings) > 1:
+            return self.run_pipelined(headings)
+        return self.run_sequential(headings)
+
+    def run_sequential(self, headings: List[str]) -> Dict[str, str]:
+        """Strict stage-major order (low-memory fallback): one model at a time."""
+        for number, name, method in self.STAGES:
+            self._emit("stage_start", stage=number, name=name)
+            start = time.perf_counter()
+            getattr(self, method)(headings)
+            self._emit("stage_end", stage=number, name=name, elapsed_s=round(time.perf_counter() - start, 2))
+        return self._ordered_sections(headings)
+
+    def _ordered_sections(self, headings: List[str]) -> Dict[str, str]:
+        # Batches finish out of order; the response keeps the template's heading order.
+        return {heading: self.final_docs.get(heading, self.detailed_docs.get(heading, "")) for heading in headings}
+
+    def run_pipelined(self, headings: List[str]) -> Dict[str, str]:
+        """
+        Each stage runs on its own worker with a bounded queue to the next one, so heading
+        k+1 can be in Stage 1 while heading k is in Stage 2 and heading k-1 in Stage 3.
+        Workers take whatever is queued (up to the decode batch size) as one micro-batch.
+        """
+        queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(2)]
+        done = object()
+
+        def _stage_worker(index: int):
+            number, name, method = self.STAGES[index]
+            inbox = queues[index - 1] if index > 0 else None
+            outbox = queues[index] if index < 2 else None
+            init_inference_thread()
+            start = None
+            try:
+                if inbox is None:
+                    pending = list(headings)
+                    batches = (pending[i:i + DECODE_BATCH_SIZE] for i in range(0, len(pending), DECODE_BATCH_SIZE))
+                else:
+                    batches = self._drain(inbox, done)
+                for batch in batches:
+                    # A stage starts when it takes its first heading, not when its worker is spawned.
+                    if start is None:
+                        start = time.perf_counter()
+                        self._emit("stage_start", stage=number, name=name)
+                    try:
+                        getattr(self, method)(batch)
+                    finally:
+                        for heading in batch:
+                            if outbox is not None:
+                                outbox.put(heading)
+            finally:
+                if outbox is not None:
+                    outbox.put(done)
+                if start is None:
+                    start = time.perf_counter()
+                    self._emit("stage_start", stage=number, name=name)
+                self._emit("stage_end", stage=number, name=name, elapsed_s=round(time.perf_counter() - start, 2))
+
+        workers = [threading.Thread(target=_stage_worker, args=(i,), name=f"doc-stage-{i + 1}", daemon=True)
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self._ordered_sections(headings)
+
+    @staticmethod
+    def _drain(inbox: "queue.Queue", done):
+        """Yields micro-batches: block for one heading, then take whatever else is already queued."""
+        while True:
+            item = inbox.get()
+            if item is done:
+                return
+            batch = [item]
+            while len(batch) < DECODE_BATCH_SIZE:
+                try:
+                    item = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is done:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+    # --- Per-heading memoization ---
+
+    def _stage_key(self, stage: int, heading: str, context: str, upstream: str, **params) -> str:
+        """Everything one stage output depends on: model, heading, context, upstream output, parameters."""
+        model_id = self.MODEL_IDS[stage - 1]
+        if model_id not in self._fingerprints:
+            self._fingerprints[model_id] = model_fingerprint(model_id)
+        return content_key({
+            "stage": stage,
+            "model": self._fingerprints[model_id],
+            "heading": heading,
+            "context": text_hash(context),
+            "upstream": text_hash(upstream),
+            "params": {**self.SAMPLING[stage], **params},
+        })
+
+    def _reuse(self, stage: int, headings: List[str], keys: Dict[str, str],
+               apply: Callable[[str, str], None]) -> List[str]:
+        """Applies cached outputs; returns the headings that still need the model."""
+        if not self.use_cache:
+            return list(headings)
+        pending = []
+        for heading in headings:
+            cached = stage_cache.get(keys[heading])
+            if cached is None:
+                pending.append(heading)
+            else:
+                apply(heading, cached)
+        if len(pending) < len(headings):
+            print(f"Stage {stage}: reused {len(headings) - len(pending)} cached heading(s)")
+        return pending
+
+    def _remember(self, stage: int, heading: str, key: str, output: str):
+        if (stage - 1, heading) not in self._fallbacks:
+            stage_cache.put(key, output)
+
+    def _fallback(self, stage: int, results: Dict[str, str], headings: List[str], placeholder: Callable[[str], str]):
+        for heading in headings:
+            if heading not in results:
+                results[heading] = placeholder(heading)
+                self._fallbacks.add((stage, heading))
+
+    def _record_lengths(self, stage: int, lengths: Dict[str, int], limits: Dict[str, int], default: int,
+                        keys: Dict[str, str], outputs: Dict[str, str]):
+        """
+        Feeds the adaptive limits, then caches the outputs that finished on their own. A row
+        cut off at its (adaptive) limit is not cached: once the limit grows it should be regenerated.
+        """
+        for heading, tokens in lengths.items():
+            length_stats.record(stage, heading, tokens, limits[heading], default)
+            if tokens < limits[heading] and heading in outputs:
+                self._remember(stage, heading, keys[heading], outputs[heading])
+        print(f"Stage {stage} tokens per heading: {lengths}")
 
     def run_stage_1_summarization(self, headings: List[str]):
         """Stage 1: Flan-T5 - Intent extraction."""
-        print("\n--- [1/3] Loading Flan-T5 (Summarizer) ---")
-        cleanup_gpu()
-        model = None
-        tokenizer = None
+        print("\n--- [1/3] Flan-T5 (Summarizer) ---")
+        # Every prompt shares the same context snippet; only the heading differs,
+        # so the whole template is encoded and decoded as one padded batch.
+        snippet = self.context['priority_context'][:800]
+        keys = {heading: self._stage_key(1, heading, snippet, "") for heading in headings}
+
+        def on_summary(heading, summary, cached=True):
+            self.summaries[heading] = summary
+            print(f"Stage 1 (Summary) for {heading}: {summary}")
+            self._emit("summary", heading=heading, content=summary, cached=cached)
+
+        pending = self._reuse(1, headings, keys, on_summary)
         try:
-            model_id = "models/flan-t5-base"
-            tokenizer = AutoTokenizer.from_pretrained(model_id, legacy=False)
-            model = AutoModelForSeq2SeqLM.from_pretrained(model_id).to(DEVICE)
-            
-            with torch.inference_mode():
-                for heading in headings:
-                    prompt = (
-                        f"Task: Write one professional technical sentence describing the section '{heading}'. "
-                        f"Context snippet: {self.context['priority_context'][:800]}"
-                    )
-                    inputs = tokenizer(prompt, return_tensors="pt", max_length=512, truncation=True).to(DEVICE)
-                    outputs = model.generate(inputs.input_ids, max_new_tokens=60)
-                    summary = tokenizer.decode(outputs[0], skip_special_tokens=True)
-                    self.summaries[heading] = summary
-                    print(f"Stage 1 (Summary) for {heading}: {summary}")
-                    
-                    del inputs, outputs
+            if pending:
+                with inference_gate.hold("models/flan-t5-base"):
+                    for start in range(0, len(pending), STAGE1_BATCH_SIZE):
+                        batch = pending[start:start + STAGE1_BATCH_SIZE]
+                        prompts = [
+                            f"Task: Write one professional technical sentence describing the section '{heading}'. "
+                            f"Context snippet: {snippet}"
+                            for heading in batch
+                        ]
+                        summaries = run_model_task("models/flan-t5-base", "summarize",
+                                                   {"prompts": prompts, **self.SAMPLING[1]})
+                        for heading, summary in zip(batch, summaries):
+                            on_summary(heading, summary, cached=False)
+                            self._remember(1, heading, keys[heading], summary)
                     
         except Exception as e:
             print(f"Stage 1 Error: {e}")
-            for heading in headings: self.summaries[heading] = "Overview of this module."
-        finally:
-            if model: del model
-            if tokenizer: del tokenizer
-            cleanup_gpu()
+            self._emit("stage_error", stage=1, detail=str(e))
+            self._fallback(1, self.summaries, headings, lambda heading: "Overview of this module.")
+
+    # Prompts are split into a job-wide prefix (prefilled once, KV cache reused) and a
+    # per-heading suffix that carries every variable part.
+
+    def _stage_2_prefix(self) -> str:
+        return (
+            f"<|system|>\n"
+            f"You are a Lead Technical Writer creating official documentation for an enterprise software project. "
+            f"Your goal is to write a precise, technically accurate section based strictly on the provided codebase analysis.\n\n"
+            f"GUIDELINES:\n"
+            f"1. Use a formal, objective tone (avoid 'I', 'we', 'here is').\n"
+            f"2. Reference specific file names and libraries from the provided Context.\n"
+            f"3. Do not invent features; rely on the File Structure and Config Context.\n"
+            f"4. Format the output with clear headings and bullet points.\n"
+            f"<|end|>\n"
+            f"<|user|>\n"
+            f"### PROJECT CONTEXT\n"
+            f"**File Structure:**\n{self.context['structure']}\n\n"
+            f"**Tech Stack & Modules:**\n{self.context['modules']}\n\n"
+            f"**Critical Configurations (Context):**\n{self.context['priority_context']}\n\n"
+        )
+
+    def _stage_2_suffix(self, heading: str) -> str:
+        summary = self.summaries.get(heading, "")
+        return (
+            f"### WRITING TASK\n"
+            f"**Section Title:** {heading}\n"
+            f"**Section Objective:** {summary}\n\n"
+            f"**Required Output Structure:**\n"
+            f"## 1. Overview\n"
+            f"(Write 2 professional paragraphs explaining the purpose of this section based on the objective.)\n\n"
+            f"## 2. Key Capabilities\n"
+            f"(List 3-5 bullet points highlighting specific features found in the code.)\n\n"
+            f"## 3. Technical Implementation\n"
+            f"(Explain how the identified files and modules interact to achieve this functionality.)\n\n"
+            f"Draft the content for '{heading}' now:\n"
+            f"<|end|>\n"
+            f"<|assistant|>"
+        )
 
     def run_stage_2_elaboration(self, headings: List[str]):
         """Stage 2: TinyLlama - Structuring Content."""
-        print("\n--- [2/3] Loading TinyLlama (Expander) ---")
-        cleanup_gpu()
-        model = None
-        tokenizer = None
-        try:
-            model_id = "models/tinyllama"
-            tokenizer = AutoTokenizer.from_pretrained(model_id, legacy=False)
-            model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float16).to(DEVICE)
-            
-            with torch.inference_mode():
-                for heading in headings:
-                    summary = self.summaries.get(heading, "")
-                    
-                    prompt = (
-                        f"<|system|>\n"
-                        f"You are a Lead Technical Writer creating official documentation for an enterprise software project. "
-                        f"Your goal is to write a precise, technically accurate section based strictly on the provided codebase analysis.\n\n"
-                        f"GUIDELINES:\n"
-                        f"1. Use a formal, objective tone (avoid 'I', 'we', 'here is').\n"
-                        f"2. Reference specific file names and libraries from the provided Context.\n"
-                        f"3. Do not invent features; rely on the File Structure and Config Context.\n"
-                        f"4. Format the output with clear headings and bullet points.\n"
-                        f"<|end|>\n"
-                        f"<|user|>\n"
-                        f"### PROJECT CONTEXT\n"
-                        f"**File Structure:**\n{self.context['structure']}\n\n"
-                        f"**Tech Stack & Modules:**\n{self.context['modules']}\n\n"
-                        f"**Critical Configurations (Context):**\n{self.context['priority_context']}\n\n"
-                        f"### WRITING TASK\n"
-                        f"**Section Title:** {heading}\n"
-                        f"**Section Objective:** {summary}\n\n"
-                        f"**Required Output Structure:**\n"
-                        f"## 1. Overview\n"
-                        f"(Write 2 professional paragraphs explaining the purpose of this section based on the objective.)\n\n"
-                        f"## 2. Key Capabilities\n"
-                        f"(List 3-5 bullet points highlighting specific features found in the code.)\n\n"
-                        f"## 3. Technical Implementation\n"
-                        f"(Explain how the identified files and modules interact to achieve this functionality.)\n\n"
-                        f"Draft the content for '{heading}' now:\n"
-                        f"<|end|>\n"
-                        f"<|assistant|>"
-                    )
-                    
-                    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-                    
-                    outputs = model.generate(
-                        inputs.input_ids, 
-                        max_new_tokens=512, 
-                        do_sample=True,
-                        temperature=0.6, 
-                        repetition_penalty=1.15
-                    )
-                    detailed = tokenizer.decode(outputs[0], skip_special_tokens=True)
-                    if "<|assistant|>" in detailed:
-                        detailed = detailed.split("<|assistant|>")[-1].strip()
-                    
-                    self.detailed_docs[heading] = detailed
-                    print(f"Stage 2 (Draft) for {heading}")
+        print("\n--- [2/3] TinyLlama (Expander) ---")
+        prefix = self._stage_2_prefix()
+        keys = {heading: self._stage_key(2, heading, prefix, self._stage_2_suffix(heading),
+                                         max_new_tokens=STAGE2_MAX_NEW_TOKENS, sections=STAGE2_SECTIONS)
+                for heading in headings}
 
-                    # PERFORMANCE FIX: Removed the slow cleanup_gpu() from inside this loop
-                    del inputs, outputs 
+        def on_cached(heading, detailed):
+            self.detailed_docs[heading] = detailed
+            self._emit("draft", heading=heading, content=detailed, cached=True)
+
+        pending = self._reuse(2, headings, keys, on_cached)
+        try:
+            if pending:
+                with inference_gate.hold("models/tinyllama"):
+                    limits = {heading: length_stats.limit(2, heading, STAGE2_MAX_NEW_TOKENS) for heading in pending}
+                    rules = [SectionsStop(STAGE2_SECTIONS), RepetitionStop(), MarkerStop(STAGE_TURN_MARKERS)]
+
+                    def on_draft(kind, result):
+                        if kind == "lengths":
+                            self._record_lengths(2, result, limits, STAGE2_MAX_NEW_TOKENS, keys, self.detailed_docs)
+                            return
+                        heading, detailed = result
+                        self.detailed_docs[heading] = detailed.strip()
+                        print(f"Stage 2 (Draft) for {heading}")
+                        self._emit("draft", heading=heading, content=self.detailed_docs[heading], cached=False)
+
+                    # Length-bucketed batches; finished drafts leave the batch early.
+                    run_model_task("models/tinyllama", "generate_batched", {
+                        "prompts": {heading: self._stage_2_suffix(heading) for heading in pending},
+                        "prefix": prefix,
+                        "max_new_tokens": limits,
+                        "stop_rules": {heading: rules for heading in pending},
+                        "batch_size": DECODE_BATCH_SIZE,
+                        **self.SAMPLING[2],
+                    }, emit=on_draft)
                     
         except Exception as e:
             print(f"Stage 2 Error: {e}")
-            for heading in headings: self.detailed_docs[heading] = "Content generation failed."
-        finally:
-            if model: del model
-            if tokenizer: del tokenizer
-            cleanup_gpu()
+            self._emit("stage_error", stage=2, detail=str(e))
+            self._fallback(2, self.detailed_docs, headings, lambda heading: "Content generation failed.")
+
+    def _stage_3_prefix(self) -> str:
+        # The code context is identical for every heading, so it sits before the draft.
+        return (
+            f"<|system|>\n"
+            f"You are a Senior Technical Editor. Your job is to format raw technical drafts into polished, publication-ready documentation.\n"
+            f"STRICT RULES:\n"
+            f"1. OUTPUT FORMAT: Use clean Markdown. Use '##' for main sections and '###' for subsections.\n"
+            f"2. TONE: Professional, objective, and concise. Remove all conversational filler (e.g., 'Here is the code', 'In this section').\n"
+            f"3. LISTS: Convert feature lists or steps into bullet points for readability.\n"
+            f"4. CODE SNIPPET: Identify the most relevant logic in the provided Code Context. Insert ONE concise snippet (max 10-12 lines) inside a ```block```. Do NOT invent code.\n"
+            f"<|end|>\n"
+            f"<|user|>\n"
+            f"AVAILABLE CODE CONTEXT:\n{self.context['general_context'][:2000]}\n\n"
+        )
+
+    def _stage_3_suffix(self, heading: str) -> str:
+        content = self.detailed_docs.get(heading, "")
+        return (
+            f"RAW DRAFT:\n{content}\n\n"
+            f"TASK: Rewrite the Raw Draft into the final Markdown format now.\n"
+            f"<|end|>\n"
+            f"<|assistant|>"
+        )
 
     def run_stage_3_polishing(self, headings: List[str]):
         """Stage 3: Gemma - Styling & Snippet Selection."""
-        print("\n--- [3/3] Loading Gemma (Polisher) ---")
-        cleanup_gpu()
-        model = None
-        tokenizer = None
-        try:
-            model_id = "models/gemma-2b-it" 
-            tokenizer = AutoTokenizer.from_pretrained(model_id, legacy=False)
-            model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float16).to(DEVICE)
-            
-            with torch.inference_mode():
-                for heading in headings:
-                    content = self.detailed_docs.get(heading, "")
-                    
-                    prompt = (
-                        f"<|system|>\n"
-                        f"You are a Senior Technical Editor. Your job is to format raw technical drafts into polished, publication-ready documentation.\n"
-                        f"STRICT RULES:\n"
-                        f"1. OUTPUT FORMAT: Use clean Markdown. Use '##' for main sections and '###' for subsections.\n"
-                        f"2. TONE: Professional, objective, and concise. Remove all conversational filler (e.g., 'Here is the code', 'In this section').\n"
-                        f"3. LISTS: Convert feature lists or steps into bullet points for readability.\n"
-                        f"4. CODE SNIPPET: Identify the most relevant logic in the provided Code Context. Insert ONE concise snippet (max 10-12 lines) inside a ```block```. Do NOT invent code.\n"
-                        f"<|end|>\n"
-                        f"<|user|>\n"
-                        f"RAW DRAFT:\n{content}\n\n"
-                        f"AVAILABLE CODE CONTEXT:\n{self.context['general_context'][:2000]}\n\n"
-                        f"TASK: Rewrite the Raw Draft into the final Markdown format now.\n"
-                        f"<|end|>\n"
-                        f"<|assistant|>"
-                    )
-                    
-                    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-                    
-                    outputs = model.generate(
-                        inputs.input_ids, 
-                        max_new_tokens=600, 
-                        do_sample=True,
-                        temperature=0.5,
-                        repetition_penalty=1.2
-                    )
-                    final_output = tokenizer.decode(outputs[0], skip_special_tokens=True)
-                    
-                    final_output = final_output.replace(prompt, "")
-                    final_output = re.sub(r"^(User:|Model:|Response:|Here is).*?\n", "", final_output, flags=re.IGNORECASE | re.MULTILINE).strip()
-                    
-                    self.final_docs[heading] = final_output
-                    print(f"Stage 3 (Final) for {heading}")
+        print("\n--- [3/3] Gemma (Polisher) ---")
+        prefix = self._stage_3_prefix()
+        keys = {heading: self._stage_key(3, heading, prefix, self._stage_3_suffix(heading),
+                                         max_new_tokens=STAGE3_MAX_NEW_TOKENS)
+                for heading in headings}
 
-                    # PERFORMANCE FIX: Removed the slow cleanup_gpu() from inside this loop
-                    del inputs, outputs
+        def on_cached(heading, final_output):
+            self.final_docs[heading] = final_output
+            self._emit("section", heading=heading, content=final_output, cached=True)
+
+        pending = self._reuse(3, headings, keys, on_cached)
+        try:
+            if pending:
+                with inference_gate.hold("models/gemma-2b-it"):
+                    limits = {heading: length_stats.limit(3, heading, STAGE3_MAX_NEW_TOKENS) for heading in pending}
+                    # The polished section keeps the draft's sections; anything after them is rambling.
+                    rules = {heading: [SectionsStop(section_titles(self.detailed_docs.get(heading, "")) or STAGE2_SECTIONS),
+                                       RepetitionStop(), MarkerStop(STAGE_TURN_MARKERS)]
+                             for heading in pending}
+
+                    def on_final(kind, result):
+                        if kind == "lengths":
+                            self._record_lengths(3, result, limits, STAGE3_MAX_NEW_TOKENS, keys, self.final_docs)
+                            return
+                        if kind == "assist":
+                            print(f"Stage 3 assisted decoding: {result}")
+                            self._emit("assist", stage=3, **result)
+                            return
+                        heading, final_output = result
+                        final_output = re.sub(r"^(User:|Model:|Response:|Here is).*?\n", "", final_output, flags=re.IGNORECASE | re.MULTILINE).strip()
+                        self.final_docs[heading] = final_output
+                        print(f"Stage 3 (Final) for {heading}")
+                        self._emit("section", heading=heading, content=final_output, cached=False)
+
+                    run_model_task("models/gemma-2b-it", "generate_batched", {
+                        "prompts": {heading: self._stage_3_suffix(heading) for heading in pending},
+                        "prefix": prefix,
+                        "max_new_tokens": limits,
+                        "stop_rules": rules,
+                        "batch_size": DECODE_BATCH_SIZE,
+                        **self.SAMPLING[3],
+                        "assist": STAGE3_ASSIST,
+                    }, emit=on_final)
                     
         except Exception as e:
             print(f"Stage 3 Error: {e}")
-            for heading in headings: self.final_docs[heading] = self.detailed_docs.get(heading, "")
-        finally:
-            if model: del model
-            if tokenizer: del tokenizer
-            cleanup_gpu()
+            self._emit("stage_error", stage=3, detail=str(e))
+            self._fallback(3, self.final_docs, headings, lambda heading: self.detailed_docs.get(heading, ""))
         
         return self.final_docs
 
 # --- FASTAPI APP ---
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    model_pool.start_reaper()
+    # Core-pinned model workers (COGNISIGHT_STAGE_WORKERS) load and warm their model on start.
+    worker_pool.start()
+    # Optional background warmup (COGNISIGHT_WARMUP_MODELS); the server accepts traffic meanwhile.
+    model_pool.start_warmup([m for m in configured_warmup_models() if m not in worker_pool.workers])
+    job_manager.start()
+    yield
+    worker_pool.stop()
+    shutdown_parse_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -320,21 +523,168 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/health")
+async def health():
+    """Liveness: the process is up. Also reports which models are resident/warm."""
+    return {
+        "status": "ok",
+        "warm_models": model_pool.warm_models(),
+        "pool": model_pool.stats(),
+        "inference": inference_gate.stats(),
+        "doc_jobs": job_manager.stats(),
+        "doc_cache": doc_cache.stats(),
+        "stage_cache": stage_cache.stats(),
+        "template_cache": template_cache.stats(),
+        "manifests": manifest_store.stats(),
+        "chat_batching": chat_batching_stats(),
+        "workers": worker_pool.stats(),
+        "chat_history": chat_history.stats(),
+        "chat_sessions": chat_sessions.stats() if worker_pool.get(CHAT_MODEL_ID) is None else {"in_worker": True},
+    }
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 only once every configured warmup model and model worker is loaded and warmed."""
+    expected = configured_warmup_models()
+    warm = model_pool.warm_models() + [m for m, w in worker_pool.workers.items() if w.ready]
+    pending = [m for m in dict.fromkeys(expected + list(worker_pool.workers)) if m not in warm]
+    errors = dict(model_pool.warmup_errors)
+    errors.update({m: w.error for m, w in worker_pool.workers.items() if w.error})
+    body = {
+        "ready": not pending,
+        "warm_models": warm,
+        "pending_models": pending,
+        "errors": errors,
+    }
+    return JSONResponse(status_code=200 if not pending else 503, content=body)
+
 @app.post("/extract-headings")
 async def extract_headings(template_file: UploadFile = File(...)):
-    content = await template_file.read()
-    text = extract_text_from_file(content, template_file.filename)
-    lines = text.split('\n')
-    headings = []
-    for line in lines:
-        clean = line.strip()
-        if len(clean) > 3 and len(clean) < 60:
-            if clean[0].isdigit() or clean.isupper() or clean.endswith(':'):
-                headings.append(clean)
-    headings = list(dict.fromkeys(headings))
+    filename = template_file.filename or ""
+    ext = os.path.splitext(filename)[1].lower()
+    digest, path = await spool_upload(template_file, suffix=ext)
+    try:
+        # Same bytes, same headings: the same template is uploaded over and over.
+        key = content_key({"sha256": digest, "format": ext, "limit": TEMPLATE_MAX_HEADINGS})
+        headings = template_cache.get(key)
+        if headings is None:
+            try:
+                headings = await asyncio.to_thread(extract_template_headings, path, filename)
+                template_cache.put(key, headings)
+            except Exception as e:
+                print(f"Error reading template: {e}")
+                headings = []
+    finally:
+        os.remove(path)
     if not headings:
-        headings = ["1. Introduction", "2. System Architecture", "3. Installation", "4. API Usage", "5. Conclusion"]
-    return {"headings": headings[:15]}
+        headings = DEFAULT_HEADINGS
+    return {"headings": headings[:TEMPLATE_MAX_HEADINGS]}
+
+def run_doc_pipeline(context_data: Dict[str, str], headings: List[str], on_event: Optional[Callable[[Dict], None]] = None,
+                     use_cache: bool = True) -> Dict[str, str]:
+    """Job runner: the full three-stage pipeline for one documentation request."""
+    return SequentialGenerator(context_data, on_event=on_event, use_cache=use_cache).run(headings)
+
+# Documentation jobs run on a bounded pool of worker threads, never on the event loop.
+job_manager = JobManager(runner=run_doc_pipeline, initializer=init_inference_thread)
+
+def doc_cache_key(context_data: Dict[str, str], headings: List[str]) -> str:
+    """Everything the generated sections depend on, besides the random seed."""
+    params = {
+        "sampling": SequentialGenerator.SAMPLING,
+        "stage2_max_new_tokens": STAGE2_MAX_NEW_TOKENS,
+        "stage3_max_new_tokens": STAGE3_MAX_NEW_TOKENS,
+        "stage3_assist": STAGE3_ASSIST,
+    }
+    return doc_cache.key(context_data, headings, [model_fingerprint(m) for m in SequentialGenerator.MODEL_IDS], params)
+
+def lookup_doc_cache(context_data: Dict[str, str], headings: List[str], use_cache: bool):
+    """(key, cached result or None); fingerprinting the models may import torch, so run it off the event loop."""
+    key = doc_cache_key(context_data, headings)
+    return key, doc_cache.get(key) if use_cache else None
+
+async def submit_doc_job(context_data: Dict[str, str], headings: List[str], project_name: str, domain: str,
+                         listener: Optional[Callable[[Dict], None]] = None, use_cache: bool = True,
+                         file_report: Optional[Dict] = None) -> DocJob:
+    """Queues a job, or answers it from the result cache (returned already done, with job.cached set)."""
+    key, cached = await asyncio.to_thread(lookup_doc_cache, context_data, headings, use_cache)
+    if cached is not None:
+        print(f"--- Doc cache hit for {project_name} ---")
+        job = job_manager.add_finished(headings, project_name, domain, cached)
+        job.reuse["files"] = file_report
+        return job
+    try:
+        job = job_manager.submit(context_data, headings, project_name, domain, listener, {"use_cache": use_cache})
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(JOB_RETRY_AFTER_S)})
+    job.reuse["files"] = file_report
+
+    def _store(future):
+        # Results with placeholder text from a failed stage are not worth replaying.
+        if future.exception() is None and not job.degraded:
+            doc_cache.put(key, future.result())
+
+    job.future.add_done_callback(_store)
+    return job
+
+async def prepare_doc_request(zip_file: UploadFile, template: str, project_name: str, use_cache: bool = True):
+    """
+    Shared by /generate-doc and /jobs: parses the upload (incrementally against the
+    project's manifest) and the heading list. Returns (context_data, headings, file report).
+    """
+    # Spooled to disk: members are read from the file one at a time, never the whole archive.
+    _, zip_path = await spool_upload(zip_file, ".zip", max_bytes=UPLOAD_MAX_MB * 2**20)
+
+    def _parse():
+        # Manifests can be megabytes of JSON: load and save them on the same thread as the parse.
+        manifest = manifest_store.load(project_name) if use_cache else ProjectManifest(project_name)
+        context_data = parse_code_context(zip_path, manifest)
+        if context_data:
+            manifest_store.save(manifest)
+        return context_data, manifest.report()
+
+    try:
+        context_data, report = await asyncio.to_thread(_parse)
+    except ZipLimitError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    finally:
+        os.remove(zip_path)
+    
+    if not context_data:
+        raise HTTPException(status_code=400, detail="Could not extract valid code from zip.")
+    print(f"Files: {report['reused_files']} unchanged, {report['parsed_files']} parsed, {report['removed_files']} removed")
+
+    headings = [h.strip() for h in template.split('\n') if h.strip()]
+    if not headings: headings = ["Overview", "Technical Implementation"]
+    return context_data, headings, report
+
+def stream_documentation(job: DocJob, events: "queue.Queue[Dict]"):
+    """
+    Yields one JSON line per job event: job_start, stage_start/stage_end, summary,
+    draft (Stage 2), section (Stage 3), heartbeat while idle, and finally done
+    (same payload as the JSON response) or error.
+    """
+    yield json.dumps({"event": "job_start", "job_id": job.id, "project_name": job.project_name, "headings": job.headings}) + "\n"
+    if job.cached:
+        for heading, content in job.result.items():
+            yield json.dumps({"event": "section", "heading": heading, "content": content}) + "\n"
+    while not job.cached:
+        try:
+            item = events.get(timeout=STREAM_HEARTBEAT_S)
+        except queue.Empty:
+            if job.future.done() and events.empty():
+                break
+            yield json.dumps({"event": "heartbeat", "status": job.status}) + "\n"
+            continue
+        yield json.dumps(item) + "\n"
+        if item.get("event") == "stage_end" and item.get("stage") == 3:
+            break
+    try:
+        sections = job.future.result()
+        yield json.dumps({"event": "done", "project_name": job.project_name, "domain": job.domain, "sections": sections,
+                          "cached": job.cached, "reuse": job.reuse}) + "\n"
+    except Exception as e:
+        yield json.dumps({"event": "error", "detail": f"Generation failed: {str(e)}"}) + "\n"
 
 @app.post("/generate-doc")
 async def generate_documentation(
@@ -342,105 +692,252 @@ async def generate_documentation(
     project_name: str = Form(...),
     project_description: str = Form(...),
     domain: str = Form(...),
-    template: str = Form(...) 
+    template: str = Form(...),
+    stream: bool = Form(False),
+    use_cache: bool = Form(True),
 ):
     print(f"\n--- New Job: {project_name} ---")
     
-    zip_content = await zip_file.read()
-    context_data = parse_code_context(zip_content)
-    
-    if not context_data:
-        raise HTTPException(status_code=400, detail="Could not extract valid code from zip.")
-
-    headings = [h.strip() for h in template.split('\n') if h.strip()]
-    if not headings: headings = ["Overview", "Technical Implementation"]
+    context_data, headings, file_report = await prepare_doc_request(zip_file, template, project_name, use_cache)
+
+    if stream:
+        # NDJSON progress events; slow jobs keep the connection alive instead of timing out.
+        events: "queue.Queue[Dict]" = queue.Queue()
+        job = await submit_doc_job(context_data, headings, project_name, domain, listener=events.put, use_cache=use_cache,
+                             file_report=file_report)
+        return StreamingResponse(
+            stream_documentation(job, events),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
+    job = await submit_doc_job(context_data, headings, project_name, domain, use_cache=use_cache, file_report=file_report)
     try:
-        generator = SequentialGenerator(context_data)
-        generator.run_stage_1_summarization(headings)
-        generator.run_stage_2_elaboration(headings) 
-        final_sections = generator.run_stage_3_polishing(headings)
+        final_sections = await asyncio.wrap_future(job.future)
         
         # Return structured JSON to frontend
         return {
             "project_name": project_name,
             "domain": domain,
-            "sections": final_sections
+            "sections": final_sections,
+            "cached": job.cached,
+            "reuse": job.reuse,
         }
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+# --- DOCUMENTATION JOB API ---
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    zip_file: UploadFile = File(...),
+    project_name: str = Form(...),
+    project_description: str = Form(...),
+    domain: str = Form(...),
+    template: str = Form(...),
+    use_cache: bool = Form(True),
+):
+    """Queues a documentation job and returns its id immediately (already done on a cache hit)."""
+    context_data, headings, file_report = await prepare_doc_request(zip_file, template, project_name, use_cache)
+    job = await submit_doc_job(context_data, headings, project_name, domain, use_cache=use_cache, file_report=file_report)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "queue_position": job_manager.position(job),
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    }
 
+@app.get("/jobs")
+async def list_jobs(status: Optional[str] = None):
+    """All retained jobs (optionally filtered, e.g. ?status=queued) plus queue depth / wait times."""
+    return {"stats": job_manager.stats(), "jobs": job_manager.list(status)}
+
+def _get_job(job_id: str) -> DocJob:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = _get_job(job_id)
+    return {**job.to_dict(), "queue_position": job_manager.position(job)}
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Generation failed: {job.error}")
+    if job.status != "done":
+        return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status},
+                            headers={"Retry-After": str(JOB_RETRY_AFTER_S)})
+    return {"project_name": job.project_name, "domain": job.domain, "sections": job.result, "reuse": job.reuse}
+
+
+def build_conversation(request: ChatRequest) -> List[Dict[str, str]]:
+    # 1. BUILD VALID CONVERSATION (Fixes the TemplateError)
+    conversation = []
+    last_role = None
+    
+    for msg in request.history:
+        # Gemma expects "assistant", not "model"
+        role = "user" if msg['role'] == "user" else "assistant"
+        
+        # Skip if the same role repeats (Gemma requires alternation)
+        if role == last_role:
+            continue
+            
+        conversation.append({"role": role, "content": msg['content']})
+        last_role = role
+    
+    # Add the current message
+    if last_role != "user":
+        conversation.append({"role": "user", "content": request.message})
+    else:
+        # If the last message in history was also "user", update it instead
+        conversation[-1]["content"] += f"\n{request.message}"
+    return conversation
+
+def overloaded(e: OverloadedError) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def summarize_history(prompt: str) -> str:
+    # Request-path model work: bounded by the gate's queue (OverloadedError -> 429), like chat itself.
+    return inference_gate.call(CHAT_SUMMARY_MODEL_ID, run_model_task, CHAT_SUMMARY_MODEL_ID, "summarize",
+                               {"prompts": [prompt], "max_length": 512, "max_new_tokens": CHAT_SUMMARY_TOKENS})[0]
+
+# Recent turns verbatim within a token budget, older ones as a cached rolling summary.
+chat_history = HistoryManager(lambda: load_tokenizer(CHAT_MODEL_ID), summarize_history)
+
+def chat_payload(request: ChatRequest):
+    """Blocking (tokenizer, maybe a summary); returns the chat task payload and the history report."""
+    conversation, history = chat_history.fit(build_conversation(request))
+    payload = {"conversation": conversation, "params": CHAT_GENERATION_KWARGS, "assist": CHAT_ASSIST,
+               "session_id": request.session_id, "stop_rules": CHAT_STOP_RULES}
+    return payload, history
+
+def chat_batching_stats() -> Dict:
+    # Concurrent chat requests share one token-step decode loop (see scheduler.py),
+    # owned by the chat model's worker process when it has one.
+    if not CHAT_BATCHED:
+        return {"enabled": False}
+    if worker_pool.get(CHAT_MODEL_ID) is not None:
+        return {"enabled": True, "in_worker": True}
+    return chat_batcher(CHAT_MODEL_ID).stats()
 
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
     print(f"\n--- Chat Request: {request.message[:50]}... ---")
     
-    cleanup_gpu()
-    
-    model_id = "models/gemma-2b-it" 
-    tokenizer = None
-    model = None
-    
     try:
-        tokenizer = AutoTokenizer.from_pretrained(model_id, legacy=False)
-        # Fixed: using 'torch_dtype' correctly or 'dtype' as suggested by your warning
-        model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float16).to(DEVICE)
-        
-        # 1. BUILD VALID CONVERSATION (Fixes the TemplateError)
-        conversation = []
-        last_role = None
-        
-        for msg in request.history:
-            # Gemma expects "assistant", not "model"
-            role = "user" if msg['role'] == "user" else "assistant"
-            
-            # Skip if the same role repeats (Gemma requires alternation)
-            if role == last_role:
-                continue
-                
-            conversation.append({"role": role, "content": msg['content']})
-            last_role = role
-        
-        # Add the current message
-        if last_role != "user":
-            conversation.append({"role": "user", "content": request.message})
+        payload, history = await asyncio.to_thread(chat_payload, request)
+        if CHAT_BATCHED:
+            # Joins the shared decode loop at the next step boundary.
+            handle = submit_model_task(CHAT_MODEL_ID, "chat", payload)
+            result = await asyncio.wrap_future(handle.future)
         else:
-            # If the last message in history was also "user", update it instead
-            conversation[-1]["content"] += f"\n{request.message}"
+            # One generate() per request, bounded by the inference gate.
+            result = await inference_gate.run(CHAT_MODEL_ID, run_model_task, CHAT_MODEL_ID, "chat", payload)
+        return {"reply": result["reply"], "usage": result["usage"], "history": history}
+
+    except OverloadedError as e:
+        raise overloaded(e)
+    except Exception as e:
+        import traceback
+        traceback.print_exc() 
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # 2. APPLY TEMPLATE
-        full_prompt = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+def sse_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        inputs = tokenizer(full_prompt, return_tensors="pt").to(DEVICE)
-        input_length = inputs.input_ids.shape[1]
-        
-        # 3. GENERATE FULL RESPONSE
-        outputs = model.generate(
-            inputs.input_ids,
-            max_new_tokens=1024, # High limit for full responses
-            do_sample=True,
-            temperature=0.7,
-            repetition_penalty=1.1
-        )
-        
-        # 4. ACCURATE DECODING
-        generated_tokens = outputs[0][input_length:]
-        response_text = tokenizer.decode(generated_tokens, skip_special_tokens=True)
+_CHAT_FINISHED = object()
 
-        return {"reply": response_text.strip()}
+def start_chat_task(payload: Dict):
+    """
+    Submits a streaming chat task. Returns (handle, text chunk queue, admitted event); the event
+    is set once the task holds its place in the batcher queue, or has already finished (e.g. rejected).
+    """
+    chunks: "queue.Queue" = queue.Queue()
+    admitted = threading.Event()
 
+    def on_event(kind, data):
+        if kind == "admitted":
+            admitted.set()
+        elif kind == "text":
+            chunks.put(data)
+
+    handle = submit_model_task(CHAT_MODEL_ID, "chat", payload, emit=on_event)
+    handle.future.add_done_callback(lambda _: (admitted.set(), chunks.put(_CHAT_FINISHED)))
+    return handle, chunks, admitted
+
+def stream_chat(payload: Dict, history: Dict, ticket=None, started=None):
+    """
+    Sync generator of SSE events: one `token` event per decoded text chunk, then a
+    `done` event with usage stats and the history report. Starlette iterates it in its threadpool. Tokens come
+    from the continuous batcher when enabled (`started`: the already admitted task from start_chat_task),
+    otherwise from a dedicated generate() whose concurrency is bounded by `ticket` (from inference_gate.admit).
+    """
+    try:
+        with (ticket or nullcontext()):
+            handle, chunks, _ = started or start_chat_task(payload)
+            completed = False
+            try:
+                while True:
+                    text = chunks.get()
+                    if text is _CHAT_FINISHED:
+                        break
+                    yield sse_event("token", {"text": text})
+                completed = True
+            finally:
+                # If the client went away (generator closed) stop decoding at the next step,
+                # and never release the ticket while generation is still running.
+                if not completed:
+                    handle.cancel()
+                    try:
+                        handle.future.result()
+                    except Exception:
+                        pass
+
+            yield sse_event("done", {**handle.future.result(), "history": history})
     except Exception as e:
         import traceback
-        traceback.print_exc() 
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if model: del model
-        if tokenizer: del tokenizer
-        cleanup_gpu()
+        traceback.print_exc()
+        yield sse_event("error", {"detail": str(e)})
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """Same as /api/chat, but streams tokens as Server-Sent Events."""
+    print(f"\n--- Chat Stream Request: {request.message[:50]}... ---")
+    # History is fitted (and maybe summarized) before the stream opens, so overload is a real 429.
+    try:
+        payload, history = await asyncio.to_thread(chat_payload, request)
+    except OverloadedError as e:
+        raise overloaded(e)
+    if CHAT_BATCHED:
+        # Wait for the batcher to take the request (or reject it) before the 200 goes out.
+        started = start_chat_task(payload)
+        await asyncio.to_thread(started[2].wait)
+        future = started[0].future
+        if future.done() and isinstance(future.exception(), OverloadedError):
+            raise overloaded(future.exception())
+        return StreamingResponse(
+            stream_chat(payload, history, started=started),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    try:
+        ticket = inference_gate.admit(CHAT_MODEL_ID)
+    except OverloadedError as e:
+        raise overloaded(e)
+    return StreamingResponse(
+        stream_chat(payload, history, ticket),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Frees the queue place even if the stream is never consumed.
+        background=BackgroundTask(ticket.release),
+    )
 
 if __name__ == "__main__":
     uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
@@ -0,0 +1,156 @@
+# manifests.py
+"""
+Per-project file manifests for incremental re-documentation.
+
+After each upload the server keeps, per project, every source file's CRC-32 and size
+(both straight from the zip directory, no decompression needed) together with its
+parse result. The next upload of the same project only reads the members whose CRC or
+size changed; everything else is taken from the manifest. Which sections then need
+regenerating is decided by the stage cache (doc_cache.stage_cache), since the prompts
+are built from the merged context. Manifests not loaded for a while expire, and the
+least recently used ones are evicted once the directory exceeds its size budget.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from doc_cache import text_hash
+
+# --- CONFIGURATION ---
+MANIFEST_DIR = os.environ.get("COGNISIGHT_MANIFEST_DIR", "models/.manifests")
+MANIFEST_MB = int(os.environ.get("COGNISIGHT_MANIFEST_MB", "64"))
+# Manifests of projects not uploaded for this many days are dropped.
+MANIFEST_MAX_AGE_DAYS = float(os.environ.get("COGNISIGHT_MANIFEST_MAX_AGE_DAYS", "30"))
+# Bumped whenever the per-file record changes; older manifests are ignored.
+MANIFEST_VERSION = 2
+
+
+class ProjectManifest:
+    def __init__(self, project: str, files: Optional[Dict[str, Dict]] = None):
+        self.project = project
+        self.previous = files or {}
+        # path -> {"crc", "size", "priority", "entry", "modules", "imports", "entry_point"} for this upload
+        self.files: Dict[str, Dict] = {}
+        self.reused = 0
+        self.parsed = 0
+        self.kept = 0
+
+    def unchanged(self, path: str, crc: int, size: int) -> Optional[Dict]:
+        """The previous parse result of `path`, if the file is unchanged."""
+        record = self.previous.get(path)
+        if record is None or record["crc"] != crc or record["size"] != size:
+            return None
+        return record
+
+    def reuse(self, path: str, record: Dict):
+        self.files[path] = record
+        self.reused += 1
+
+    def keep(self, path: str, record: Dict):
+        """Carries over an entry that was not needed this time (not counted as reused)."""
+        self.files[path] = record
+        self.kept += 1
+
+    def record(self, path: str, record: Dict):
+        self.files[path] = record
+        self.parsed += 1
+
+    def report(self) -> Dict:
+        changed = sum(1 for path in self.files if path in self.previous) - self.reused - self.kept
+        return {
+            "files": len(self.files),
+            "reused_files": self.reused,
+            "parsed_files": self.parsed,
+            "unread_files": self.kept,
+            "changed_files": changed,
+            "new_files": self.parsed - changed,
+            "removed_files": len(set(self.previous) - set(self.files)),
+        }
+
+
+class ManifestStore:
+    """One JSON file per project name; LRU by mtime within a size budget and a maximum age."""
+
+    def __init__(self, directory: str = MANIFEST_DIR, budget_mb: int = MANIFEST_MB,
+                 max_age_days: float = MANIFEST_MAX_AGE_DAYS):
+        self.directory = directory
+        self.budget_bytes = budget_mb * 2**20
+        self.max_age_s = max_age_days * 86400
+        self._lock = threading.Lock()
+        # Metrics
+        self.evictions = 0
+
+    def _path(self, project: str) -> str:
+        return os.path.join(self.directory, text_hash(project)[:32] + ".json")
+
+    def load(self, project: str) -> ProjectManifest:
+        path = self._path(project)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_s:
+                return ProjectManifest(project)
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            files = data["files"] if data.get("version") == MANIFEST_VERSION else {}
+            os.utime(path)  # mtime doubles as the LRU clock
+        except (OSError, ValueError, KeyError):
+            files = {}
+        return ProjectManifest(project, files)
+
+    def save(self, manifest: ProjectManifest):
+        path = self._path(manifest.project)
+        try:
+            with self._lock:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp = path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"version": MANIFEST_VERSION, "project": manifest.project, "files": manifest.files}, f, ensure_ascii=False)
+                os.replace(tmp, path)
+                self._evict()
+        except OSError as e:
+            print(f"Could not save manifest for {manifest.project}: {e}")
+
+    def _entries(self) -> List[tuple]:
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        expired = time.time() - self.max_age_s
+        for mtime, size, path in entries:
+            if total <= self.budget_bytes and mtime >= expired:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        entries = self._entries()
+        with self._lock:
+            return {
+                "projects": len(entries),
+                "size_mb": round(sum(size for _, size, _ in entries) / 2**20, 2),
+                "budget_mb": round(self.budget_bytes / 2**20),
+                "max_age_days": self.max_age_s / 86400,
+                "evictions": self.evictions,
+            }
+
+
+manifest_store = ManifestStore()
@@ -0,0 +1,566 @@
+# model_manager.py
+import gc
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# NOTE: torch / transformers are imported lazily so that importing this module
+# (and main_fastapi) stays cheap until a model is actually needed.
+
+# --- CONFIGURATION ---
+# RAM budget for resident models (MB). Models are evicted LRU once exceeded.
+MODEL_RAM_BUDGET_MB = int(os.environ.get("COGNISIGHT_MODEL_RAM_BUDGET_MB", "12000"))
+# Models unused for this many seconds are unloaded (0 disables the TTL).
+MODEL_IDLE_TTL = float(os.environ.get("COGNISIGHT_MODEL_IDLE_TTL", "900"))
+
+# Pre-converted safetensors (final dtype/layout) live here; see `python model_manager.py convert`.
+WEIGHT_CACHE_DIR = os.environ.get("COGNISIGHT_WEIGHT_CACHE_DIR", "models/.weight_cache")
+CACHE_MARKER = "cognisight_cache.json"
+
+# Comma separated model ids to preload + warm in the background at startup ("all" = every known model).
+WARMUP_MODELS = os.environ.get("COGNISIGHT_WARMUP_MODELS", "")
+
+# Numeric precision: "auto" (picked from device + CPU ISA), or fp32 / bf16 / fp16 / int8.
+# Either one value for every model, or per model: "models/tinyllama=int8,models/gemma-2b-it=bf16".
+PRECISION_CONFIG = os.environ.get("COGNISIGHT_PRECISION", "auto")
+
+# Known pipeline models and how they must be loaded.
+MODEL_SPECS = {
+    "models/flan-t5-base": {"kind": "seq2seq"},
+    "models/tinyllama": {"kind": "causal"},
+    "models/gemma-2b-it": {"kind": "causal"},
+}
+
+# Weight dtype each precision is loaded/cached in (int8 quantizes fp32 weights after loading).
+PRECISION_DTYPES = {"fp32": "float32", "bf16": "bfloat16", "fp16": "float16", "int8": "float32"}
+
+_DEVICE: Optional[str] = None
+
+
+def get_device() -> str:
+    """Probes for CUDA on first use instead of at import time."""
+    global _DEVICE
+    if _DEVICE is None:
+        import torch
+        if torch.cuda.is_available():
+            _DEVICE = "cuda"
+            print(f"\n{'='*40}")
+            print(f"✅ HARDWARE ACCELERATION ENABLED")
+            print(f"🚀 DEVICE: {_DEVICE.upper()} ({torch.cuda.get_device_name(0)})")
+            print(f"{'='*40}\n")
+            # Optional: Enable CUDNN benchmark for slight speedup on fixed input sizes
+            torch.backends.cudnn.benchmark = True
+        else:
+            _DEVICE = "cpu"
+            print(f"\n{'='*40}")
+            print(f"⚠️  NO GPU DETECTED - RUNNING ON CPU")
+            print(f"🐢 Expect significantly slower generation times.")
+            print(f"{'='*40}\n")
+    return _DEVICE
+
+
+def cleanup_gpu():
+    """Aggressively clears GPU memory."""
+    import torch
+    if torch.cuda.is_available():
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+# --- PRECISION POLICY ---
+
+_CPU_FLAGS: Optional[set] = None
+
+
+def cpu_isa_flags() -> set:
+    """CPU feature flags relevant to bf16 / int8 kernels."""
+    global _CPU_FLAGS
+    if _CPU_FLAGS is None:
+        flags = set()
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("flags"):
+                        flags.update(line.split(":", 1)[1].split())
+                        break
+        except OSError:
+            pass
+        if not flags:
+            # Non-Linux hosts: fall back to what torch detected at build/run time.
+            import torch
+            capability = torch.backends.cpu.get_cpu_capability().lower()
+            if "avx512" in capability:
+                flags.update({"avx2", "avx512f"})
+            elif "avx2" in capability:
+                flags.add("avx2")
+        _CPU_FLAGS = flags
+    return _CPU_FLAGS
+
+
+def auto_precision(model_id: str) -> str:
+    if get_device() != "cpu":
+        # T5 overflows in fp16, so it keeps full precision on GPU (as before).
+        return "fp32" if MODEL_SPECS.get(model_id, {}).get("kind") == "seq2seq" else "fp16"
+    flags = cpu_isa_flags()
+    if flags & {"amx_bf16", "avx512_bf16"}:
+        return "bf16"
+    if flags & {"avx2", "avx512_vnni", "avx_vnni"}:
+        return "int8"
+    return "fp32"
+
+
+def resolve_precision(model_id: str) -> str:
+    """Applies COGNISIGHT_PRECISION overrides on top of the automatic policy."""
+    choice = "auto"
+    for item in PRECISION_CONFIG.split(","):
+        item = item.strip()
+        if "=" in item:
+            mid, value = item.split("=", 1)
+            if mid.strip() == model_id:
+                choice = value.strip().lower()
+        elif item:
+            choice = item.lower()
+    if choice == "auto" or choice not in PRECISION_DTYPES:
+        choice = auto_precision(model_id)
+    if choice == "fp16" and get_device() == "cpu":
+        choice = "fp32"  # fp16 matmuls are emulated on most CPUs
+    if choice == "int8" and get_device() != "cpu":
+        choice = "fp16"  # dynamic quantization kernels are CPU only
+    return choice
+
+
+def configured_warmup_models() -> List[str]:
+    if WARMUP_MODELS.strip().lower() == "all":
+        return list(MODEL_SPECS)
+    return [m.strip() for m in WARMUP_MODELS.split(",") if m.strip()]
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    """Process-lifetime peak RSS (ru_maxrss is KB on Linux, bytes on macOS)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _mb(nbytes: Optional[int]) -> Optional[float]:
+    return None if nbytes is None else round(nbytes / 2**20, 1)
+
+
+# --- WEIGHT CACHE ---
+
+def _cache_path(model_id: str, dtype_name: Optional[str]) -> str:
+    name = os.path.basename(os.path.normpath(model_id))
+    return os.path.join(WEIGHT_CACHE_DIR, f"{name}-{dtype_name or 'default'}")
+
+
+def cached_weights_path(model_id: str, dtype_name: Optional[str]) -> Optional[str]:
+    """Returns the converted checkpoint for this model/dtype if it exists and is not stale."""
+    path = _cache_path(model_id, dtype_name)
+    marker = os.path.join(path, CACHE_MARKER)
+    if not os.path.isfile(marker):
+        return None
+    try:
+        with open(marker) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("source_mtime") != _source_mtime(model_id):
+        print(f"Weight cache for {model_id} is stale, ignoring it.")
+        return None
+    return path
+
+
+def _source_mtime(model_id: str) -> float:
+    if not os.path.isdir(model_id):
+        return 0.0
+    return max((os.path.getmtime(os.path.join(model_id, n)) for n in os.listdir(model_id)), default=0.0)
+
+
+def model_fingerprint(model_id: str) -> Dict:
+    """Identifies the weights a model would run with (for caches of generated output)."""
+    return {"model": model_id, "precision": resolve_precision(model_id), "source_mtime": _source_mtime(model_id)}
+
+
+def convert_to_cache(model_id: str, precision: Optional[str] = None) -> str:
+    """
+    One-time conversion: loads the original checkpoint, casts it to its runtime dtype
+    and writes contiguous safetensors that later loads can mmap directly.
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoModelForCausalLM
+
+    spec = MODEL_SPECS.get(model_id, {"kind": "causal"})
+    dtype_name = PRECISION_DTYPES[precision or resolve_precision(model_id)]
+    target = _cache_path(model_id, dtype_name)
+    tmp = target + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n--- Converting {model_id} -> {target} ({dtype_name}) ---")
+    model_cls = AutoModelForSeq2SeqLM if spec["kind"] == "seq2seq" else AutoModelForCausalLM
+    model = model_cls.from_pretrained(model_id, torch_dtype=getattr(torch, dtype_name), low_cpu_mem_usage=True)
+    for param in model.parameters():
+        param.data = param.data.contiguous()
+    model.save_pretrained(tmp, safe_serialization=True)
+    AutoTokenizer.from_pretrained(model_id, legacy=False).save_pretrained(tmp)
+    with open(os.path.join(tmp, CACHE_MARKER), "w") as f:
+        json.dump({"source": model_id, "dtype": dtype_name, "source_mtime": _source_mtime(model_id)}, f)
+    del model
+    gc.collect()
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    return target
+
+
+def load_model(model_id: str, precision: str):
+    """Loads (model, tokenizer, from_cache) in the given precision on the active device."""
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoModelForCausalLM
+
+    spec = MODEL_SPECS.get(model_id, {"kind": "causal"})
+    device = get_device()
+    dtype_name = PRECISION_DTYPES[precision]
+    cached = cached_weights_path(model_id, dtype_name)
+    source = cached or model_id
+
+    tokenizer = AutoTokenizer.from_pretrained(source, legacy=False)
+    model_cls = AutoModelForSeq2SeqLM if spec["kind"] == "seq2seq" else AutoModelForCausalLM
+    kwargs = {"low_cpu_mem_usage": True, "torch_dtype": getattr(torch, dtype_name)}
+    if cached and device != "cpu":
+        # Already in runtime dtype: stream tensors from the mmap straight onto the device.
+        kwargs["device_map"] = device
+    model = model_cls.from_pretrained(source, **kwargs)
+    if "device_map" not in kwargs:
+        model = model.to(device)
+    model.eval()
+
+    if precision == "int8":
+        # Dynamic int8: Linear weights quantized once, activations quantized per batch.
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, tokenizer, bool(cached)
+
+
+_tokenizers: Dict[str, object] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def load_tokenizer(model_id: str):
+    """Tokenizer only (no weights), e.g. for counting tokens outside the process that hosts the model."""
+    with _tokenizers_lock:
+        if model_id not in _tokenizers:
+            from transformers import AutoTokenizer
+            _tokenizers[model_id] = AutoTokenizer.from_pretrained(model_id, legacy=False)
+        return _tokenizers[model_id]
+
+
+def _model_nbytes(model) -> int:
+    """Resident size of a loaded model (parameters + buffers)."""
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    total += sum(b.numel() * b.element_size() for b in model.buffers())
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(module, "weight"):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+    return total
+
+
+def _checkpoint_nbytes(model_id: str) -> int:
+    """Rough size estimate from the weight files on disk, used before loading."""
+    total = 0
+    if os.path.isdir(model_id):
+        for name in os.listdir(model_id):
+            if name.endswith((".safetensors", ".bin", ".pt")):
+                total += os.path.getsize(os.path.join(model_id, name))
+    return total
+
+
+def _estimate_runtime_nbytes(model_id: str, precision: str) -> int:
+    """Checkpoint size rescaled from its on-disk dtype to the runtime precision."""
+    disk_bytes = {"float32": 4, "bfloat16": 2, "float16": 2}
+    runtime_bytes = {"fp32": 4, "bf16": 2, "fp16": 2, "int8": 1.5}  # int8: embeddings/norms stay float
+    try:
+        with open(os.path.join(model_id, "config.json")) as f:
+            disk = disk_bytes.get(str(json.load(f).get("torch_dtype", "float32")), 4)
+    except (OSError, ValueError):
+        disk = 4
+    return int(_checkpoint_nbytes(model_id) / disk * runtime_bytes.get(precision, 4))
+
+
+class _PoolEntry:
+    def __init__(self, model, tokenizer, nbytes: int):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.nbytes = nbytes
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+
+class ModelPool:
+    """
+    Process-wide pool of resident models and tokenizers.
+    Models stay loaded until the RAM budget forces an LRU eviction
+    or they have been idle longer than the TTL.
+    """
+
+    def __init__(self, budget_mb: int = MODEL_RAM_BUDGET_MB, idle_ttl: float = MODEL_IDLE_TTL):
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.idle_ttl = idle_ttl
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._reaper: Optional[threading.Thread] = None
+        self._warm: set = set()
+        self.warmup_errors: Dict[str, str] = {}
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.load_metrics: Dict[str, Dict] = {}
+        self._known_nbytes: Dict[str, int] = {}
+
+    # --- Loading ---
+
+    def _load(self, model_id: str) -> _PoolEntry:
+        precision = resolve_precision(model_id)
+        print(f"\n--- Loading {model_id} into model pool ({precision}) ---")
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        model, tokenizer, cached = load_model(model_id, precision)
+
+        entry = _PoolEntry(model, tokenizer, _model_nbytes(model))
+        rss_after = _rss_bytes()
+        metrics = {
+            "precision": precision,
+            "from_cache": cached,
+            "load_s": round(time.perf_counter() - start, 2),
+            "rss_delta_mb": _mb(rss_after - rss_before) if rss_before is not None else None,
+            "peak_rss_mb": _mb(_peak_rss_bytes()),
+        }
+        self.load_metrics[model_id] = metrics
+        self._known_nbytes[model_id] = entry.nbytes
+        print(f"Loaded {model_id} ({entry.nbytes / 2**20:.0f} MB, {'weight cache' if cached else 'checkpoint'}) in {metrics['load_s']}s "
+              f"| RSS +{metrics['rss_delta_mb']} MB | peak RSS {metrics['peak_rss_mb']} MB")
+        return entry
+
+    @contextmanager
+    def acquire(self, model_id: str):
+        """Yields (model, tokenizer); the model cannot be evicted while held."""
+        entry = self._checkout(model_id)
+        try:
+            yield entry.model, entry.tokenizer
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+            self.evict_idle()
+
+    def _checkout(self, model_id: str) -> _PoolEntry:
+        self.evict_idle()
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None:
+                entry.in_use += 1
+                self._entries.move_to_end(model_id)
+                self.hits += 1
+                return entry
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+
+        # Only one thread loads a given model; others wait and reuse it.
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(model_id)
+                if entry is not None:
+                    entry.in_use += 1
+                    self._entries.move_to_end(model_id)
+                    self.hits += 1
+                    return entry
+                self._evict_for(_checkpoint_nbytes(model_id))
+
+            entry = self._load(model_id)
+
+            with self._lock:
+                entry.in_use += 1
+                self._entries[model_id] = entry
+                self.loads += 1
+                self._evict_for(0)
+            return entry
+
+    def estimated_nbytes(self, model_id: str) -> int:
+        """Resident size if the model was loaded before, otherwise an estimate from its checkpoint."""
+        with self._lock:
+            if model_id in self._known_nbytes:
+                return self._known_nbytes[model_id]
+        return _estimate_runtime_nbytes(model_id, resolve_precision(model_id))
+
+    def fits_together(self, model_ids: List[str]) -> bool:
+        """Whether all these models can be resident at once within the RAM budget."""
+        return sum(self.estimated_nbytes(mid) for mid in model_ids) <= self.budget_bytes
+
+    # --- Eviction ---
+
+    def _resident_bytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    def _evict_for(self, incoming_bytes: int):
+        """Evicts least-recently-used idle models until `incoming_bytes` fits the budget."""
+        while self._resident_bytes() + incoming_bytes > self.budget_bytes:
+            victim = next((mid for mid, e in self._entries.items() if e.in_use == 0), None)
+            if victim is None:
+                break
+            self._drop(victim, reason="budget")
+
+    def _drop(self, model_id: str, reason: str):
+        entry = self._entries.pop(model_id)
+        self._warm.discard(model_id)
+        print(f"--- Evicting {model_id} from model pool ({reason}) ---")
+        del entry.model, entry.tokenizer
+        self.evictions += 1
+        cleanup_gpu()
+
+    def evict_idle(self):
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for model_id in [mid for mid, e in self._entries.items()
+                             if e.in_use == 0 and now - e.last_used > self.idle_ttl]:
+                self._drop(model_id, reason="idle")
+
+    def clear(self):
+        with self._lock:
+            for model_id in [mid for mid, e in self._entries.items() if e.in_use == 0]:
+                self._drop(model_id, reason="clear")
+
+    def start_reaper(self, interval: float = 60.0):
+        """Background thread that enforces the idle TTL between requests."""
+        if self._reaper is not None or self.idle_ttl <= 0:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=_loop, name="model-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    # --- Warmup / readiness ---
+
+    def warmup(self, model_ids: List[str]):
+        """Loads each model and runs one tiny generation so kernels/allocations are primed."""
+        import torch
+        for model_id in model_ids:
+            try:
+                start = time.perf_counter()
+                with self.acquire(model_id) as (model, tokenizer), torch.inference_mode():
+                    inputs = tokenizer("Hello", return_tensors="pt").to(model.device)
+                    model.generate(inputs.input_ids, max_new_tokens=2, do_sample=False)
+                    with self._lock:
+                        if model_id in self._entries:
+                            self._warm.add(model_id)
+                self.warmup_errors.pop(model_id, None)
+                print(f"🔥 Warmed {model_id} in {time.perf_counter() - start:.1f}s")
+            except Exception as e:
+                self.warmup_errors[model_id] = str(e)
+                print(f"Warmup Error ({model_id}): {e}")
+
+    def start_warmup(self, model_ids: List[str]) -> Optional[threading.Thread]:
+        if not model_ids:
+            return None
+        thread = threading.Thread(target=self.warmup, args=(model_ids,), name="model-pool-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def warm_models(self) -> List[str]:
+        with self._lock:
+            return sorted(self._warm)
+
+    def is_warm(self, model_id: str) -> bool:
+        with self._lock:
+            return model_id in self._warm
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "resident": {mid: {"mb": round(e.nbytes / 2**20), "in_use": e.in_use, "warm": mid in self._warm,
+                                   "idle_s": round(time.monotonic() - e.last_used, 1)}
+                             for mid, e in self._entries.items()},
+                "resident_mb": round(self._resident_bytes() / 2**20),
+                "budget_mb": round(self.budget_bytes / 2**20),
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "load_metrics": dict(self.load_metrics),
+            }
+
+
+# Process-wide pool shared by chat and every documentation stage.
+model_pool = ModelPool()
+
+
+
+def bench_precisions(model_id: str, precisions: Optional[List[str]] = None, max_new_tokens: int = 64) -> Dict[str, Dict]:
+    """Greedy tokens/sec for one model across precisions (same prompt, same token count)."""
+    import torch
+
+    if precisions is None:
+        precisions = ["fp32", "bf16", "int8"] if get_device() == "cpu" else ["fp32", "fp16"]
+    prompt = "Explain how a FastAPI backend loads transformer models and serves documentation requests."
+    results = {}
+    for precision in precisions:
+        try:
+            start = time.perf_counter()
+            model, tokenizer, _ = load_model(model_id, precision)
+            load_s = time.perf_counter() - start
+            with torch.inference_mode():
+                inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+                model.generate(inputs.input_ids, max_new_tokens=4, do_sample=False)  # warm kernels
+                start = time.perf_counter()
+                outputs = model.generate(inputs.input_ids, max_new_tokens=max_new_tokens,
+                                         min_new_tokens=max_new_tokens, do_sample=False)
+                elapsed = time.perf_counter() - start
+            generated = outputs.shape[1] - (0 if model.config.is_encoder_decoder else inputs.input_ids.shape[1])
+            results[precision] = {"load_s": round(load_s, 2), "tokens": int(generated),
+                                  "tokens_per_s": round(generated / elapsed, 2),
+                                  "mb": round(_model_nbytes(model) / 2**20)}
+            del model, tokenizer
+            gc.collect()
+        except Exception as e:
+            results[precision] = {"error": str(e)}
+    return results
+
+if __name__ == "__main__":
+    # One-time weight conversion:  python model_manager.py convert [model_id ...]
+    # Precision comparison:        python model_manager.py bench [model_id ...]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("convert", "bench"):
+        print("Usage: python model_manager.py convert|bench [model_id ...]")
+        sys.exit(1)
+    for mid in sys.argv[2:] or list(MODEL_SPECS):
+        if sys.argv[1] == "convert":
+            convert_to_cache(mid)
+            pool = ModelPool(idle_ttl=0)
+            with pool.acquire(mid):
+                pass
+            print(f"{mid}: {pool.load_metrics[mid]}")
+        else:
+            print(f"\n=== {mid} (auto policy: {resolve_precision(mid)}, CPU flags: "
+                  f"{sorted(cpu_isa_flags() & {'avx2', 'avx512f', 'avx512_vnni', 'avx_vnni', 'avx512_bf16', 'amx_bf16'})}) ===")
+            for precision, row in bench_precisions(mid).items():
+                print(f"{precision:>5}: {row}")
@@ -0,0 +1,67 @@
+# pools.py
+"""
+Shared process pool for CPU-bound parsing (template pages, source files).
+
+Task functions must live in light modules (templates.py, code_context.py): the
+pool spawns fresh interpreters that import them, never the FastAPI app.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+# --- CONFIGURATION ---
+PARSE_PROCESSES = int(os.environ.get("COGNISIGHT_PARSE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parse_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing as mp
+            # Spawned, like the model workers: the API process may already hold torch threads.
+            _pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=mp.get_context("spawn"))
+        return _pool
+
+
+def shutdown_parse_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def ordered_map(fn: Callable, tasks: Iterable[tuple], parallel: bool = True) -> Iterator:
+    """
+    Yields fn(*task) for each task, in task order. In parallel mode one task per process
+    is kept in flight ahead of the consumer; when the consumer stops early (closes the
+    generator), tasks that have not started are cancelled.
+    """
+    tasks = iter(tasks)
+    if not parallel or PARSE_PROCESSES < 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+
+    pool = parse_pool()
+    in_flight = []
+
+    def submit_next():
+        task = next(tasks, None)
+        if task is not None:
+            in_flight.append(pool.submit(fn, *task))
+
+    for _ in range(PARSE_PROCESSES):
+        submit_next()
+    try:
+        while in_flight:
+            result = in_flight.pop(0).result()
+            submit_next()
+            yield result
+    finally:
+        for future in in_flight:
+            future.cancel()
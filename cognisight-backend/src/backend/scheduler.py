@@ -0,0 +1,315 @@
+# scheduler.py
+"""
+Continuous batching for chat.
+
+One background thread owns a shared decode loop per model. New requests are prefilled
+on their own and merged into the running batch at the next step boundary; finished
+requests leave the batch immediately. Every request keeps its own sampling parameters.
+
+The batch KV cache is kept left-padded: rows of different lengths are aligned on the
+right and the padding columns are masked out, exactly like `generation.decode_batch`.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+from generation import build_logits_processors, eos_token_ids, select_next_tokens
+from stopping import check_rules
+from inference import OverloadedError, init_inference_thread
+
+# --- CONFIGURATION ---
+# Merge concurrent /api/chat requests into one decode loop (set to 0 for per-request generate()).
+CHAT_CONTINUOUS_BATCHING = os.environ.get("COGNISIGHT_CHAT_BATCHING", "1") == "1"
+# Max requests decoded together; the rest wait at step boundaries.
+CHAT_MAX_BATCH = int(os.environ.get("COGNISIGHT_CHAT_MAX_BATCH", "8"))
+# Requests allowed to wait for a batch row before new ones are rejected with 429.
+CHAT_MAX_WAITING = int(os.environ.get("COGNISIGHT_CHAT_MAX_WAITING", "16"))
+
+
+# --- KV cache helpers ---
+
+def cache_tensors(cache) -> List[tuple]:
+    """Per-layer (key, value) tensors of a KV cache, shaped [batch, heads, seq, dim]."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(layer[0], layer[1]) for layer in cache]
+
+
+def build_cache(tensors: List[tuple]):
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(tensors):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def _left_pad_seq(tensor, width: int, dim: int):
+    import torch
+
+    missing = width - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class ChatJob:
+    def __init__(self, prompt_fn: Callable, params: Dict, on_token: Optional[Callable[[int], None]] = None,
+                 session_id: Optional[str] = None, stop_rules: Optional[list] = None):
+        # prompt_fn(tokenizer) -> prompt token ids; runs on the batcher thread, which owns the tokenizer.
+        self.prompt_fn = prompt_fn
+        self.prompt_ids: List[int] = []
+        self.session_id = session_id
+        self.stop_rules = stop_rules or []  # stopping.StopRule list, checked after every token
+        self.reused_tokens = 0  # prompt tokens served from the session's KV cache
+        self.params = params
+        self.on_token = on_token
+        self.cancelled = False
+        self.generated: List[int] = []
+        self.future: Future = Future()
+        self.submitted_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.sequence = None  # prompt + generated ids (tensor), used by repetition penalty
+        self.processors = None
+        self.next_token: Optional[int] = None
+
+    def cancel(self):
+        """Finishes the request at the next step (e.g. the streaming client disconnected)."""
+        self.cancelled = True
+
+    def usage(self) -> Dict:
+        decode_s = (self.finished_at or time.perf_counter()) - (self.first_token_at or self.submitted_at)
+        return {
+            "prompt_tokens": len(self.prompt_ids),
+            "cached_prompt_tokens": self.reused_tokens,
+            "generated_tokens": len(self.generated),
+            "queue_wait_s": round((self.started_at or self.submitted_at) - self.submitted_at, 3),
+            "time_to_first_token_s": round((self.first_token_at or self.submitted_at) - self.submitted_at, 3),
+            "total_time_s": round((self.finished_at or time.perf_counter()) - self.submitted_at, 3),
+            "tokens_per_s": round(len(self.generated) / decode_s, 2) if decode_s > 0 else None,
+        }
+
+
+class ContinuousBatcher:
+    """Shared token-step decode loop for one causal model, fed by `submit()` from any thread."""
+
+    def __init__(self, model_id: str, pool, max_batch: int = CHAT_MAX_BATCH, max_waiting: int = CHAT_MAX_WAITING,
+                 sessions=None):
+        self.model_id = model_id
+        self.pool = pool
+        # Optional sessions.SessionCache: multi-turn requests resume from their previous KV cache.
+        self.sessions = sessions
+        self.max_batch = max_batch
+        self.max_waiting = max_waiting
+        self._pending: "deque[ChatJob]" = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        # Metrics
+        self.steps = 0
+        self.occupied_rows = 0
+        self.completed = 0
+        self.tokens_out = 0
+        self._latencies: "deque[float]" = deque(maxlen=200)
+        self._busy_s = 0.0
+        self._tokenizer = None
+
+    def submit(self, prompt_fn: Callable, params: Dict, on_token: Optional[Callable[[int], None]] = None,
+               session_id: Optional[str] = None, stop_rules: Optional[list] = None) -> ChatJob:
+        """Queues a request; `job.future` resolves to the decoded reply text."""
+        job = ChatJob(prompt_fn, params, on_token, session_id, stop_rules)
+        with self._cond:
+            self._check_capacity()
+            self._pending.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="chat-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return job
+
+    def check_capacity(self):
+        """Raises OverloadedError if submit() would be rejected right now (lets streams fail before they start)."""
+        with self._cond:
+            self._check_capacity()
+
+    def _check_capacity(self):
+        if len(self._pending) >= self.max_waiting:
+            raise OverloadedError(self.model_id, retry_after=5)
+
+    # --- Decode loop ---
+
+    def _loop(self):
+        init_inference_thread()
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            try:
+                # Hold the model lease only while there is work, so the pool may evict it when idle.
+                with self.pool.acquire(self.model_id) as (model, tokenizer):
+                    self._run(model, tokenizer)
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                with self._cond:
+                    failed, self._pending = list(self._pending), deque()
+                for job in failed:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _run(self, model, tokenizer):
+        import torch
+
+        active: List[ChatJob] = []
+        kv: List[tuple] = []
+        mask = None
+        eos_ids = eos_token_ids(model, tokenizer)
+        self._tokenizer = tokenizer
+
+        with torch.inference_mode():
+            try:
+                while True:
+                    # 1. Join: prefill waiting requests and merge them in at this step boundary.
+                    while len(active) < self.max_batch:
+                        with self._cond:
+                            job = self._pending.popleft() if self._pending else None
+                        if job is None:
+                            break
+                        joined = self._prefill(model, job, eos_ids)
+                        if joined is None:
+                            continue
+                        job_kv, job_mask = joined
+                        if not active:
+                            kv, mask = job_kv, job_mask
+                        else:
+                            width = max(mask.shape[1], job_mask.shape[1])
+                            kv = [(torch.cat([_left_pad_seq(k, width, 2), _left_pad_seq(jk, width, 2)]),
+                                   torch.cat([_left_pad_seq(v, width, 2), _left_pad_seq(jv, width, 2)]))
+                                  for (k, v), (jk, jv) in zip(kv, job_kv)]
+                            mask = torch.cat([_left_pad_seq(mask, width, 1), _left_pad_seq(job_mask, width, 1)])
+                        active.append(job)
+                    if not active:
+                        return
+
+                    # 2. One decode step for every active row.
+                    step_start = time.perf_counter()
+                    next_ids = torch.tensor([[job.next_token] for job in active], device=model.device)
+                    mask = torch.cat([mask, mask.new_ones((len(active), 1))], dim=1)
+                    position_ids = mask.sum(-1, keepdim=True) - 1
+                    out = model(input_ids=next_ids, attention_mask=mask, position_ids=position_ids,
+                                past_key_values=build_cache(kv), use_cache=True)
+                    kv = cache_tensors(out.past_key_values)
+                    logits = out.logits[:, -1, :]
+                    self.steps += 1
+                    self.occupied_rows += len(active)
+
+                    keep = []
+                    for row, job in enumerate(active):
+                        job.sequence = torch.cat([job.sequence, next_ids[row]])
+                        if self._accept(job, select_next_tokens(job.processors, job.sequence[None], logits[row:row + 1],
+                                                                job.params["do_sample"]), eos_ids):
+                            keep.append(row)
+                    self._busy_s += time.perf_counter() - step_start
+
+                    # 3. Leave: finished rows drop out; fully padded leading columns are trimmed.
+                    if len(keep) < len(active):
+                        self._remember([job for row, job in enumerate(active) if row not in keep],
+                                       [row for row in range(len(active)) if row not in keep], kv)
+                        active = [active[row] for row in keep]
+                        if not active:
+                            kv, mask = [], None
+                            continue
+                        rows = torch.tensor(keep, device=mask.device)
+                        mask = mask[rows]
+                        first = int((mask.sum(0) > 0).nonzero()[0])
+                        mask = mask[:, first:]
+                        kv = [(k[rows][:, :, first:], v[rows][:, :, first:]) for k, v in kv]
+            except Exception as e:
+                for job in active:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                raise
+
+    def _prefill(self, model, job: ChatJob, eos_ids: set):
+        import torch
+
+        job.started_at = time.perf_counter()
+        try:
+            job.prompt_ids = list(job.prompt_fn(self._tokenizer))
+        except Exception as e:
+            job.future.set_exception(e)
+            return None
+        params = job.params
+        job.processors = build_logits_processors(model, params["do_sample"], params.get("temperature", 1.0),
+                                                 params.get("repetition_penalty", 1.0))
+        job.sequence = torch.tensor(job.prompt_ids, dtype=torch.long, device=model.device)
+        past = None
+        if self.sessions is not None:
+            # Earlier turns of the conversation are already in the session's cache.
+            job.reused_tokens, kv = self.sessions.lookup(self.model_id, job.session_id, job.prompt_ids)
+            past = build_cache(kv) if kv is not None else None
+        out = model(input_ids=job.sequence[None, job.reused_tokens:], past_key_values=past, use_cache=True)
+        token = select_next_tokens(job.processors, job.sequence[None], out.logits[:, -1, :], params["do_sample"])
+        if not self._accept(job, token, eos_ids):
+            return None
+        return cache_tensors(out.past_key_values), torch.ones((1, len(job.prompt_ids)), dtype=torch.long, device=model.device)
+
+    def _remember(self, jobs: List[ChatJob], rows: List[int], kv: List[tuple]):
+        """Saves finished rows' caches (without left padding) for their sessions' next turn."""
+        if self.sessions is None:
+            return
+        for job, row in zip(jobs, rows):
+            if job.session_id:
+                # The row's cache covers exactly job.sequence: prompt + every token fed back so far.
+                n = job.sequence.shape[0]
+                self.sessions.store(self.model_id, job.session_id, len(job.prompt_ids), job.sequence.tolist(),
+                                    [(k[row:row + 1, :, -n:], v[row:row + 1, :, -n:]) for k, v in kv])
+
+    def _accept(self, job: ChatJob, token_tensor, eos_ids: set) -> bool:
+        """Records one sampled token; returns False once the request is finished."""
+        token = int(token_tensor[0])
+        if job.first_token_at is None:
+            job.first_token_at = time.perf_counter()
+        if token not in eos_ids and not job.cancelled:
+            job.generated.append(token)
+            self.tokens_out += 1
+            if job.on_token:
+                job.on_token(token)
+            cut = check_rules(job.stop_rules, job.generated, self._decode) if job.stop_rules else None
+            if cut is not None:
+                del job.generated[cut:]
+            elif len(job.generated) < job.params["max_new_tokens"]:
+                job.next_token = token
+                return True
+        job.finished_at = time.perf_counter()
+        self.completed += 1
+        self._latencies.append(job.finished_at - job.submitted_at)
+        job.future.set_result(self._tokenizer.decode(job.generated, skip_special_tokens=True).strip())
+        return False
+
+    def _decode(self, ids: List[int]) -> str:
+        return self._tokenizer.decode(ids, skip_special_tokens=True)
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+        with self._cond:
+            waiting = len(self._pending)
+        return {
+            "enabled": True,
+            "max_batch": self.max_batch,
+            "waiting": waiting,
+            "steps": self.steps,
+            "avg_batch_occupancy": round(self.occupied_rows / self.steps, 2) if self.steps else 0.0,
+            "completed": self.completed,
+            "throughput_tokens_per_s": round(self.tokens_out / self._busy_s, 2) if self._busy_s else 0.0,
+            "latency_p50_s": round(latencies[len(latencies) // 2], 2) if latencies else None,
+            "latency_p95_s": round(latencies[int(len(latencies) * 0.95)], 2) if latencies else None,
+        }
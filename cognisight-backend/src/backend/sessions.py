@@ -0,0 +1,122 @@
+# sessions.py
+"""
+Per-session KV caches for multi-turn chat.
+
+After each reply the conversation's KV cache (prompt + reply, as fed to the model) is
+kept under the request's session id. The next turn's prompt starts with the same
+tokens, so only the new part needs a prefill. The store is a bounded LRU (entry count,
+memory cap, idle TTL) and lives in whichever process hosts the chat model.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# --- CONFIGURATION ---
+CHAT_SESSION_MAX = int(os.environ.get("COGNISIGHT_CHAT_SESSIONS", "64"))
+CHAT_SESSION_CACHE_MB = int(os.environ.get("COGNISIGHT_CHAT_SESSION_CACHE_MB", "1024"))
+CHAT_SESSION_TTL = float(os.environ.get("COGNISIGHT_CHAT_SESSION_TTL", "1800"))
+
+
+class _Session:
+    def __init__(self, model_id: str, prompt_length: int, token_ids: List[int], kv: List[tuple]):
+        self.model_id = model_id
+        self.prompt_length = prompt_length
+        self.token_ids = token_ids
+        self.kv = kv
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+        self.last_used = time.monotonic()
+
+
+class SessionCache:
+    def __init__(self, max_sessions: int = CHAT_SESSION_MAX, budget_mb: int = CHAT_SESSION_CACHE_MB,
+                 ttl: float = CHAT_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.budget_bytes = budget_mb * 2**20
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def lookup(self, model_id: str, session_id: Optional[str], prompt_ids: List[int]) -> Tuple[int, Optional[List[tuple]]]:
+        """
+        Returns (n, kv): the first `n` prompt tokens are already in `kv` (per-layer tensors,
+        batch 1). The cached tokens are the previous prompt followed by the reply as the model
+        generated it; the reply may be re-tokenized differently once it is part of the history,
+        so reuse stops at the first differing token. If the previous *prompt* itself no longer
+        matches (history was edited), the session is dropped and (0, None) means full rebuild.
+        """
+        if not session_id:
+            return 0, None
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is None or session.model_id != model_id:
+                self.misses += 1
+                return 0, None
+            common = 0
+            for a, b in zip(session.token_ids, prompt_ids):
+                if a != b:
+                    break
+                common += 1
+            if common < session.prompt_length:
+                del self._sessions[session_id]
+                self.mismatches += 1
+                return 0, None
+            # At least one prompt token must still be fed to get the next-token logits.
+            common = min(common, len(prompt_ids) - 1)
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            self.reused_tokens += common
+            return common, [(k[:, :, :common], v[:, :, :common]) for k, v in session.kv]
+
+    def store(self, model_id: str, session_id: Optional[str], prompt_length: int, token_ids: List[int],
+              kv: List[tuple]):
+        """Keeps a copy of `kv` (covering exactly `token_ids`, batch 1) as the session's latest state."""
+        if not session_id:
+            return
+        session = _Session(model_id, prompt_length, token_ids, [(k.clone(), v.clone()) for k, v in kv])
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if session.nbytes > self.budget_bytes:
+                return
+            self._sessions[session_id] = session
+            while (len(self._sessions) > self.max_sessions
+                   or sum(s.nbytes for s in self._sessions.values()) > self.budget_bytes):
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def drop(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id in [sid for sid, s in self._sessions.items() if now - s.last_used > self.ttl]:
+            del self._sessions[session_id]
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._expire()
+            return {
+                "sessions": len(self._sessions),
+                "cached_mb": round(sum(s.nbytes for s in self._sessions.values()) / 2**20, 1),
+                "budget_mb": round(self.budget_bytes / 2**20),
+                "hits": self.hits,
+                "misses": self.misses,
+                "mismatches": self.mismatches,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
+
+
+# Process-wide store, used by whichever process hosts the chat model.
+chat_sessions = SessionCache()
@@ -0,0 +1,217 @@
+# stopping.py
+"""
+Structure-aware stopping rules and adaptive token limits.
+
+A rule looks at one row's generated tokens (and, if it needs to, their decoded text)
+every few steps. When it fires, the row stops and `check()` says how many tokens to
+keep; `finalize()` then trims the decoded text (e.g. a heading the model started after
+the last expected section). Rules are plain objects so they can be sent to worker
+processes with the rest of a task payload.
+"""
+import json
+import math
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Optional
+
+# --- CONFIGURATION ---
+# Per-(stage, heading) output lengths seen so far; drives the adaptive token limits.
+LENGTH_STATS_PATH = os.environ.get("COGNISIGHT_LENGTH_STATS", "models/.length_stats.json")
+# Headroom over a heading's typical length, and the floor below which limits never go.
+LENGTH_HEADROOM = 1.5
+MIN_TOKEN_LIMIT = 128
+
+
+class StopRule:
+    every = 1  # check interval, in generated tokens
+    needs_text = False
+
+    def check(self, tokens: List[int], text: Optional[str]) -> Optional[int]:
+        """None to continue, otherwise the number of generated tokens to keep."""
+        return None
+
+    def finalize(self, text: str) -> str:
+        return text
+
+
+class RepetitionStop(StopRule):
+    """Runaway loops: the trailing n-gram already occurred `max_repeats - 1` times. Keeps the first copy."""
+
+    every = 4
+
+    def __init__(self, ngram: int = 12, max_repeats: int = 3):
+        self.ngram = ngram
+        self.max_repeats = max_repeats
+
+    def check(self, tokens, text):
+        n = self.ngram
+        if len(tokens) < n * self.max_repeats:
+            return None
+        tail = tokens[-n:]
+        starts = [i for i in range(len(tokens) - n + 1) if tokens[i:i + n] == tail]
+        if len(starts) >= self.max_repeats:
+            return starts[1]
+        return None
+
+
+class MarkerStop(StopRule):
+    """Chat-template markers in plain text (the model starting another turn)."""
+
+    every = 2
+    needs_text = True
+
+    def __init__(self, markers: List[str]):
+        self.markers = markers
+
+    def check(self, tokens, text):
+        return len(tokens) if any(marker in text for marker in self.markers) else None
+
+    def finalize(self, text):
+        cut = min((text.find(m) for m in self.markers if m in text), default=-1)
+        return text[:cut] if cut >= 0 else text
+
+
+class SectionsStop(StopRule):
+    """
+    Output with a known shape: stops at the first top-level heading after the last expected
+    section. Headings are matched by title, so a leading document title or a `##` line the
+    model writes before the sections does not count; lines inside code fences are ignored.
+    """
+
+    every = 8
+    needs_text = True
+    HEADING = re.compile(r"^##(?!#)\s*(\S.*)$", re.MULTILINE)
+    FENCE = re.compile(r"^\s*(```|~~~)", re.MULTILINE)
+
+    def __init__(self, sections: List[str]):
+        self.sections = [_title_key(title) for title in sections]
+
+    def _extra_heading(self, text: str) -> Optional[int]:
+        expected = 0
+        for start, title in _headings(text, self.HEADING, self.FENCE):
+            # Only complete heading lines count, so a heading still being written is not cut mid-way.
+            if text.find("\n", start) < 0:
+                return None
+            if expected == len(self.sections):
+                return start
+            key = _title_key(title)
+            for i in range(expected, len(self.sections)):
+                if f" {self.sections[i]} " in f" {key} ":
+                    expected = i + 1
+                    break
+        return None
+
+    def check(self, tokens, text):
+        return len(tokens) if self._extra_heading(text) is not None else None
+
+    def finalize(self, text):
+        cut = self._extra_heading(text + "\n")
+        return text[:cut].rstrip() if cut is not None else text
+
+
+def _title_key(title: str) -> str:
+    """'**2. Key Capabilities:**' -> 'key capabilities'."""
+    return re.sub(r"^[0-9 ]+", "", re.sub(r"[^a-z0-9]+", " ", title.lower())).strip()
+
+
+def _headings(text: str, heading: re.Pattern, fence: re.Pattern):
+    """(offset, title) of the top-level headings of `text` that are outside code fences."""
+    fences = [m.start() for m in fence.finditer(text)]
+    for m in heading.finditer(text):
+        if sum(1 for f in fences if f < m.start()) % 2 == 0:
+            yield m.start(), m.group(1)
+
+
+def section_titles(text: str) -> List[str]:
+    """Titles of the top-level sections of `text`, in order (code fences excluded)."""
+    return [title for _, title in _headings(text, SectionsStop.HEADING, SectionsStop.FENCE)]
+
+
+def check_rules(rules: List[StopRule], tokens: List[int], decode: Callable[[List[int]], str]) -> Optional[int]:
+    """Runs the rules due at this length; returns the tokens to keep if one fires."""
+    text = None
+    for rule in rules:
+        if len(tokens) % rule.every:
+            continue
+        if rule.needs_text and text is None:
+            text = decode(tokens)
+        keep = rule.check(tokens, text)
+        if keep is not None:
+            return keep
+    return None
+
+
+def finalize_text(rules: List[StopRule], text: str) -> str:
+    for rule in rules:
+        text = rule.finalize(text)
+    return text
+
+
+def stopping_criteria(rules: List[StopRule], prompt_length: int, decode: Callable[[List[int]], str]):
+    """The same rules as a transformers StoppingCriteria for model.generate() (batch 1)."""
+    from transformers import StoppingCriteria
+
+    class _RulesCriteria(StoppingCriteria):
+        def __init__(self):
+            self.keep: Optional[int] = None
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.keep is None:
+                self.keep = check_rules(rules, input_ids[0, prompt_length:].tolist(), decode)
+            return self.keep is not None
+
+    return _RulesCriteria()
+
+
+class LengthStats:
+    """
+    Moving average of how many tokens each (stage, heading) produced, persisted to disk.
+    Limits follow it with headroom, and grow again whenever a heading hits its limit.
+    """
+
+    def __init__(self, path: str = LENGTH_STATS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+        try:
+            with open(path) as f:
+                self._stats = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _key(stage: int, heading: str) -> str:
+        return f"{stage}:{re.sub(r'[^a-z0-9]+', ' ', heading.lower()).strip()}"
+
+    def limit(self, stage: int, heading: str, default: int) -> int:
+        with self._lock:
+            entry = self._stats.get(self._key(stage, heading))
+        if entry is None:
+            return default
+        return max(MIN_TOKEN_LIMIT, min(default, math.ceil(entry["avg"] * LENGTH_HEADROOM)))
+
+    def record(self, stage: int, heading: str, tokens: int, limit: int, default: int):
+        key = self._key(stage, heading)
+        with self._lock:
+            entry = self._stats.get(key)
+            if tokens >= limit:
+                # Cut off: it needed at least this much; let the next limit open up towards the default.
+                tokens = min(default, math.ceil(limit * LENGTH_HEADROOM))
+            avg = tokens if entry is None else 0.7 * entry["avg"] + 0.3 * tokens
+            self._stats[key] = {"avg": round(avg, 1), "runs": (entry or {}).get("runs", 0) + 1}
+            self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self._stats, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not save length stats: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"headings": len(self._stats)}
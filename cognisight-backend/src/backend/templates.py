@@ -0,0 +1,106 @@
+# templates.py
+"""
+Heading extraction for documentation templates (PDF / DOCX).
+
+Templates are scanned page by page (paragraph by paragraph for DOCX) and the scan
+stops as soon as enough headings are found, so a 200-page corporate template costs
+its first few pages. The first page chunk is always read in-process; past it, long
+PDFs are scanned in page chunks on the shared parse pool, a few chunks ahead of the
+consumer (each worker keeps its own reader); results are still taken in page order. The
+headings are cached by the template's content hash (doc_cache.template_cache).
+"""
+import os
+from typing import Iterator, List
+
+from pools import ordered_map
+
+# --- CONFIGURATION ---
+# Headings returned to the client (the scan stops once this many distinct ones are found).
+TEMPLATE_MAX_HEADINGS = 15
+# PDFs with at least this many pages are scanned on the shared parse pool (pools.py).
+TEMPLATE_PARALLEL_PAGES = int(os.environ.get("COGNISIGHT_TEMPLATE_PARALLEL_PAGES", "24"))
+# Pages per pool task.
+TEMPLATE_PAGE_CHUNK = 8
+
+
+def is_heading(line: str) -> bool:
+    return 3 < len(line) < 60 and (line[0].isdigit() or line.isupper() or line.endswith(':'))
+
+
+def collect_headings(lines: Iterator[str], limit: int = TEMPLATE_MAX_HEADINGS) -> List[str]:
+    """First `limit` distinct heading-like lines; stops pulling lines once it has them."""
+    headings = {}
+    for line in lines:
+        clean = line.strip()
+        if is_heading(clean):
+            headings[clean] = None
+            if len(headings) >= limit:
+                break
+    return list(headings)
+
+
+# --- PDF ---
+
+# Pool worker state: the reader of the template this process last scanned, keyed by
+# (path, mtime, size). pypdf reads the file into memory, so no file handle stays open.
+_reader_key = None
+_reader = None
+
+
+def _pdf_reader(path: str):
+    global _reader_key, _reader
+    from pypdf import PdfReader
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key != _reader_key:
+        _reader_key, _reader = None, None
+        _reader = PdfReader(path)
+        _reader_key = key
+    return _reader
+
+
+def _page_lines(reader, start: int, end: int) -> Iterator[str]:
+    for page in reader.pages[start:end]:
+        extracted = page.extract_text()
+        if extracted:
+            yield from extracted.split("\n")
+
+
+def _pdf_page_lines(path: str, start: int, end: int) -> List[str]:
+    """Pool task: the text lines of pages [start, end), with the worker's reader for `path`."""
+    return list(_page_lines(_pdf_reader(path), start, end))
+
+
+def _iter_pdf_lines(path: str) -> Iterator[str]:
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    total = len(reader.pages)
+    # Most templates have their headings on the first pages: scan those here before involving the pool.
+    yield from _page_lines(reader, 0, TEMPLATE_PAGE_CHUNK)
+    if total < TEMPLATE_PARALLEL_PAGES:
+        yield from _page_lines(reader, TEMPLATE_PAGE_CHUNK, total)
+        return
+
+    # The rest is read a few chunks ahead on the pool; stopping early cancels the rest.
+    chunks = ((path, start, min(total, start + TEMPLATE_PAGE_CHUNK))
+              for start in range(TEMPLATE_PAGE_CHUNK, total, TEMPLATE_PAGE_CHUNK))
+    for lines in ordered_map(_pdf_page_lines, chunks):
+        yield from lines
+
+
+# --- DOCX ---
+
+def _iter_docx_lines(path: str) -> Iterator[str]:
+    from docx import Document
+    for para in Document(path).paragraphs:
+        yield para.text
+
+
+def extract_headings(path: str, filename: str, limit: int = TEMPLATE_MAX_HEADINGS) -> List[str]:
+    """Headings of the template at `path` (`filename` gives the format); raises if it cannot be read."""
+    ext = filename.split('.')[-1].lower()
+    if ext == 'pdf':
+        return collect_headings(_iter_pdf_lines(path), limit)
+    if ext == 'docx':
+        return collect_headings(_iter_docx_lines(path), limit)
+    return []
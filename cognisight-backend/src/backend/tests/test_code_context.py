@@ -0,0 +1,18 @@
+from code_context import _python_imports
+
+
+def test_python_imports_single_line():
+    raw = "import os, app.db as db\nfrom .models import User, Post\nfrom pkg import *\n"
+    assert _python_imports(raw) == ["os", "app.db", ".models.User", ".models.Post"]
+
+
+def test_python_imports_parenthesized_multi_line():
+    raw = (
+        "from app.services import (\n"
+        "    auth,  # login, tokens\n"
+        "    billing as pay,\n"
+        ")\n"
+        "from . import (views)\n"
+        "x = 1\n"
+    )
+    assert _python_imports(raw) == ["app.services.auth", "app.services.billing", ".views"]
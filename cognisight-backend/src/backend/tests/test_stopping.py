@@ -0,0 +1,39 @@
+from stopping import SectionsStop, finalize_text, section_titles
+
+SECTIONS = ["Overview", "Key Capabilities", "Technical Implementation"]
+
+
+def test_leading_title_heading_does_not_count():
+    text = (
+        "## Project Documentation\n"
+        "## 1. Overview\nText.\n\n"
+        "## 2. Key Capabilities\n- a\n\n"
+        "## 3. Technical Implementation\nHow it works.\n\n"
+        "## 4. Future Work\nRambling.\n"
+    )
+    rule = SectionsStop(SECTIONS)
+    assert rule.check([0] * 8, text) == 8
+    assert rule.finalize(text).endswith("How it works.")
+
+
+def test_last_section_is_not_cut_before_it_finishes():
+    text = "## Project Documentation\n## 1. Overview\nText.\n## Key Capabilities\n- a\n## 3. Technical Implementation\n"
+    rule = SectionsStop(SECTIONS)
+    assert rule.check([0] * 8, text) is None
+    assert finalize_text([rule], text) == text
+
+
+def test_headings_inside_code_fences_are_ignored():
+    text = (
+        "## Overview\nText.\n## Key Capabilities\n- a\n## Technical Implementation\n"
+        "```bash\n## install\npip install .\n```\nDone.\n"
+    )
+    assert SectionsStop(SECTIONS).finalize(text) == text
+    assert section_titles(text) == SECTIONS
+
+
+def test_incomplete_heading_line_does_not_stop():
+    text = "## Overview\nA.\n## Key Capabilities\nB.\n## Technical Implementation\nC.\n## Conc"
+    rule = SectionsStop(SECTIONS)
+    assert rule.check([0] * 8, text) is None
+    assert rule.finalize(text).endswith("C.")
@@ -0,0 +1,646 @@
+# workers.py
+"""
+Model tasks and where they run.
+
+Every model call made by the API is a named task (summarize / generate_batched / chat).
+A task runs either in-process against the shared model pool or, when
+COGNISIGHT_STAGE_WORKERS gives its model a core set, in a long-lived worker process
+that is pinned to those cores and keeps the model resident. Callers use
+`run_model_task()` / `submit_model_task()` and do not need to know which one it is.
+Only a ready, live worker gets tasks; while it is loading, or after it failed or
+died, its model's tasks run in-process instead.
+"""
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from model_manager import model_pool
+from generation import (DraftModel, PromptLookup, build_logits_processors, decode_assisted, eos_token_ids,
+                        generate_batched, new_assist_stats, prefill_prefix, summarize_assist_stats,
+                        tokenizers_compatible)
+from inference import OverloadedError, init_inference_thread
+from scheduler import CHAT_CONTINUOUS_BATCHING, ContinuousBatcher, build_cache, cache_tensors
+from sessions import chat_sessions
+from stopping import finalize_text, stopping_criteria
+
+# --- CONFIGURATION ---
+# Dedicated, core-pinned worker process per model, e.g.
+#   "models/flan-t5-base=0-3;models/tinyllama=4-11;models/gemma-2b-it=12-23"
+# Models without an entry run inside the API process.
+STAGE_WORKERS_CONFIG = os.environ.get("COGNISIGHT_STAGE_WORKERS", "")
+# Tasks a worker process runs concurrently (e.g. chat requests next to a doc stage).
+WORKER_TASK_THREADS = int(os.environ.get("COGNISIGHT_WORKER_TASK_THREADS", "4"))
+# Prefilled prompt prefixes kept per process (Stage 2/3 system + context blocks).
+PREFIX_CACHE_ENTRIES = int(os.environ.get("COGNISIGHT_PREFIX_CACHE_ENTRIES", "4"))
+
+
+def parse_core_list(spec: str) -> List[int]:
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cores.extend(range(int(lo), int(hi) + 1))
+        else:
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+def parse_worker_config(config: str) -> Dict[str, List[int]]:
+    assignments: Dict[str, List[int]] = {}
+    for item in config.split(";"):
+        if "=" not in item:
+            continue
+        model_id, cores = item.split("=", 1)
+        assignments[model_id.strip()] = parse_core_list(cores)
+    # Pinning to a core this process may not run on fails inside the child, after it has started.
+    available = set(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    used: set = set()
+    for model_id, cores in assignments.items():
+        if not cores:
+            raise ValueError(f"COGNISIGHT_STAGE_WORKERS: no cores given for {model_id}.")
+        if available is not None and not available.issuperset(cores):
+            missing = sorted(set(cores) - available)
+            raise ValueError(f"COGNISIGHT_STAGE_WORKERS: cores {missing} for {model_id} are not available "
+                             f"to this process (available: {sorted(available)}).")
+        if used & set(cores):
+            raise ValueError(f"COGNISIGHT_STAGE_WORKERS: cores for {model_id} overlap another worker.")
+        used.update(cores)
+    return assignments
+
+
+class TaskContext:
+    """Lets a running task stream partial output (`emit`) and notice cancellation."""
+
+    def __init__(self, emit: Optional[Callable[[str, object], None]] = None):
+        self._emit = emit
+        self.cancel_event = threading.Event()
+
+    @property
+    def streaming(self) -> bool:
+        return self._emit is not None
+
+    def emit(self, kind: str, data):
+        if self._emit:
+            self._emit(kind, data)
+
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+
+class TaskHandle:
+    def __init__(self, future: Future, cancel: Callable[[], None]):
+        self.future = future
+        self.cancel = cancel
+
+
+# --- TASKS (run wherever the model lives) ---
+
+_prefix_caches: "OrderedDict[tuple, object]" = OrderedDict()
+_prefix_lock = threading.Lock()
+
+
+def _cached_prefix(model_id: str, model, tokenizer, prefix: str):
+    """Process-wide LRU of prefilled prefixes, so every micro-batch of a job reuses one prefill."""
+    key = (model_id, hashlib.sha1(prefix.encode("utf-8")).hexdigest())
+    with _prefix_lock:
+        if key in _prefix_caches:
+            _prefix_caches.move_to_end(key)
+            return _prefix_caches[key]
+    prefilled = prefill_prefix(model, tokenizer, prefix)
+    with _prefix_lock:
+        _prefix_caches[key] = prefilled
+        while len(_prefix_caches) > PREFIX_CACHE_ENTRIES:
+            _prefix_caches.popitem(last=False)
+    return prefilled
+
+
+@contextmanager
+def assistant_for(spec: Optional[str], tokenizer):
+    """
+    Assisted decoding from a config string: "prompt_lookup" or "draft:<model path>".
+    A draft model whose tokenizer differs from the main one falls back to prompt lookup.
+    """
+    if not spec:
+        yield None
+    elif spec.startswith("draft:"):
+        draft_id = spec[len("draft:"):]
+        with model_pool.acquire(draft_id) as (draft_model, draft_tokenizer):
+            if tokenizers_compatible(tokenizer, draft_tokenizer):
+                yield DraftModel(draft_model)
+            else:
+                print(f"--- {draft_id} does not share the tokenizer; using prompt lookup instead ---")
+                yield PromptLookup()
+    else:
+        yield PromptLookup()
+
+
+def task_summarize(model_id: str, model, tokenizer, payload: Dict, ctx: TaskContext) -> List[str]:
+    """Seq2seq batch: one padded encoder/decoder pass for all prompts."""
+    import torch
+
+    with torch.inference_mode():
+        inputs = tokenizer(payload["prompts"], return_tensors="pt", max_length=payload.get("max_length", 512),
+                           truncation=True, padding=True).to(model.device)
+        outputs = model.generate(**inputs, max_new_tokens=payload["max_new_tokens"])
+        return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+def task_generate_batched(model_id: str, model, tokenizer, payload: Dict, ctx: TaskContext) -> Dict[str, str]:
+    """Length-bucketed causal generation; emits ("result", (key, text)) as each prompt finishes."""
+    prefix = payload.get("prefix")
+    prefix_cache = None
+    if prefix is not None:
+        prefix_cache = {prefix: _cached_prefix(model_id, model, tokenizer, prefix)}
+    assist_stats = new_assist_stats()
+    lengths: Dict[str, int] = {}
+    with assistant_for(payload.get("assist"), tokenizer) as assistant:
+        results = generate_batched(
+            model, tokenizer, payload["prompts"], payload["max_new_tokens"],
+            batch_size=payload.get("batch_size", 4),
+            do_sample=payload.get("do_sample", False),
+            temperature=payload.get("temperature", 1.0),
+            repetition_penalty=payload.get("repetition_penalty", 1.0),
+            prefix=prefix, prefix_cache=prefix_cache,
+            on_result=lambda key, text: ctx.emit("result", (key, text)),
+            assistant=assistant, assist_stats=assist_stats,
+            stop_rules=payload.get("stop_rules"), lengths=lengths,
+        )
+    if assistant is not None:
+        ctx.emit("assist", summarize_assist_stats(assist_stats))
+    ctx.emit("lengths", lengths)
+    return results
+
+
+def _chat_prompt_ids(tokenizer, conversation: List[Dict[str, str]]) -> List[int]:
+    full_prompt = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+    return tokenizer(full_prompt).input_ids
+
+
+def task_chat(model_id: str, model, tokenizer, payload: Dict, ctx: TaskContext) -> Dict:
+    """Single-request chat generation; emits ("text", chunk) while decoding when streaming."""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+    class _Cancelled(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            return ctx.cancelled()
+
+    class _FirstToken(StoppingCriteria):
+        """Stopping criteria run after every decoding step: the first call marks the first token."""
+
+        def __init__(self):
+            self.at = None
+
+        def __call__(self, input_ids, scores, **kwargs):
+            self.at = self.at or time.perf_counter()
+            return False
+
+    prompt_ids = _chat_prompt_ids(tokenizer, payload["conversation"])
+    if payload.get("assist"):
+        with assistant_for(payload["assist"], tokenizer) as assistant:
+            return _chat_assisted(model, tokenizer, prompt_ids, payload["params"], assistant, ctx,
+                                  payload.get("stop_rules"))
+
+    input_ids = torch.tensor([prompt_ids], device=model.device)
+    input_length = input_ids.shape[1]
+    decode = lambda ids: tokenizer.decode(ids, skip_special_tokens=True)
+    rules = stopping_criteria(payload.get("stop_rules") or [], input_length, decode)
+    first_token = _FirstToken()
+    kwargs = dict(payload["params"], stopping_criteria=StoppingCriteriaList([first_token, _Cancelled(), rules]),
+                  eos_token_id=sorted(eos_token_ids(model, tokenizer)), return_dict_in_generate=True)
+    session_id = payload.get("session_id")
+    reused, kv = chat_sessions.lookup(model_id, session_id, prompt_ids)
+    if kv is not None:
+        # generate() only prefills the prompt tokens the cache does not cover yet.
+        kwargs["past_key_values"] = build_cache(kv)
+    start = time.perf_counter()
+
+    if not ctx.streaming:
+        with torch.inference_mode():
+            outputs = model.generate(input_ids, **kwargs)
+    else:
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        threads = torch.get_num_threads()
+        result = {}
+
+        def _generate():
+            torch.set_num_threads(threads)  # same core share as the calling thread
+            try:
+                with torch.inference_mode():
+                    result["outputs"] = model.generate(input_ids, streamer=streamer, **kwargs)
+            except Exception as e:
+                result["error"] = e
+                streamer.end()
+
+        worker = threading.Thread(target=_generate, daemon=True)
+        worker.start()
+        for text in streamer:
+            if text:
+                ctx.emit("text", text)
+        # Never release the model lease while generate() is still running.
+        worker.join()
+        if "error" in result:
+            raise result["error"]
+        outputs = result["outputs"]
+
+    elapsed = time.perf_counter() - start
+    sequence = outputs.sequences[0]
+    generated = sequence[input_length:]
+    if rules.keep is not None:
+        generated = generated[:rules.keep]
+    if session_id:
+        layers = cache_tensors(outputs.past_key_values)
+        cached = layers[0][0].shape[2]  # the last generated token is never fed back
+        chat_sessions.store(model_id, session_id, input_length, sequence[:cached].tolist(), layers)
+    # Same clock for both paths: the end of the first decoding step (prefill + one token).
+    first_token_at = first_token.at or time.perf_counter()
+    decode_time = elapsed - (first_token_at - start)
+    return {
+        "reply": finalize_text(payload.get("stop_rules") or [], decode(generated)).strip(),
+        "usage": {
+            "prompt_tokens": int(input_length),
+            "cached_prompt_tokens": reused,
+            "generated_tokens": int(generated.shape[0]),
+            "time_to_first_token_s": round(first_token_at - start, 3),
+            "total_time_s": round(elapsed, 3),
+            # Tokens after the first one, over the time after the first one.
+            "tokens_per_s": (round((int(generated.shape[0]) - 1) / decode_time, 2)
+                             if decode_time > 0 and generated.shape[0] > 1 else None),
+        },
+    }
+
+
+def _chat_assisted(model, tokenizer, prompt_ids: List[int], params: Dict, assistant, ctx: TaskContext,
+                   stop_rules: Optional[list] = None) -> Dict:
+    """Chat reply via assisted decoding; quoted code from the history is proposed by the assistant."""
+    import torch
+
+    processors = build_logits_processors(model, params["do_sample"], params.get("temperature", 1.0),
+                                         params.get("repetition_penalty", 1.0))
+    stats = new_assist_stats()
+    start = time.perf_counter()
+    state = {"ids": [], "sent": "", "first_token_at": None}
+
+    def on_tokens(tokens: List[int]):
+        state["first_token_at"] = state["first_token_at"] or time.perf_counter()
+        state["ids"].extend(tokens)
+        text = tokenizer.decode(state["ids"], skip_special_tokens=True)
+        # Hold back a trailing replacement char: the rest of a multi-byte character is still coming.
+        if ctx.streaming and not text.endswith("\ufffd") and len(text) > len(state["sent"]):
+            ctx.emit("text", text[len(state["sent"]):])
+            state["sent"] = text
+
+    decode = lambda ids: tokenizer.decode(ids, skip_special_tokens=True)
+    with torch.inference_mode():
+        generated = decode_assisted(model, prompt_ids, params["max_new_tokens"], processors, params["do_sample"],
+                                    eos_token_ids(model, tokenizer), assistant, stats=stats,
+                                    on_tokens=on_tokens, should_stop=ctx.cancelled,
+                                    stop_rules=stop_rules, decode=decode)
+    elapsed = time.perf_counter() - start
+    first_token_at = state["first_token_at"] or time.perf_counter()
+    decode_time = elapsed - (first_token_at - start)
+    reply = finalize_text(stop_rules or [], decode(generated))
+    if ctx.streaming and len(reply) > len(state["sent"]):
+        ctx.emit("text", reply[len(state["sent"]):])
+    return {
+        "reply": reply.strip(),
+        "usage": {
+            "prompt_tokens": len(prompt_ids),
+            "generated_tokens": len(generated),
+            "time_to_first_token_s": round(first_token_at - start, 3),
+            "total_time_s": round(elapsed, 3),
+            "tokens_per_s": round(len(generated) / decode_time, 2) if decode_time > 0 else None,
+            "assist": summarize_assist_stats(stats),
+        },
+    }
+
+
+TASKS = {
+    "summarize": task_summarize,
+    "generate_batched": task_generate_batched,
+    "chat": task_chat,
+}
+
+# Continuous batchers, one per chat model, owned by whichever process hosts the model.
+_batchers: Dict[str, ContinuousBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def chat_batcher(model_id: str) -> ContinuousBatcher:
+    with _batchers_lock:
+        if model_id not in _batchers:
+            _batchers[model_id] = ContinuousBatcher(model_id, model_pool, sessions=chat_sessions)
+        return _batchers[model_id]
+
+
+def _chat_batched(model_id: str, payload: Dict, ctx: TaskContext) -> Dict:
+    """Chat through the shared decode loop; text chunks are emitted as tokens arrive."""
+    import torch
+    from transformers import TextIteratorStreamer
+
+    conversation = payload["conversation"]
+    batcher = chat_batcher(model_id)
+    # Streaming callers wait for this before sending their response headers, so a full queue is still a 429.
+    batcher.check_capacity()
+    ctx.emit("admitted", None)
+    streamer = None
+    on_token = None
+    if ctx.streaming:
+        with model_pool.acquire(model_id) as (_, tokenizer):
+            # Only generated ids are pushed into the streamer, so nothing is skipped.
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=False, skip_special_tokens=True)
+        on_token = lambda token: streamer.put(torch.tensor([token]))
+    job = batcher.submit(lambda tokenizer: _chat_prompt_ids(tokenizer, conversation), payload["params"], on_token,
+                         session_id=payload.get("session_id"), stop_rules=payload.get("stop_rules"))
+    if streamer is not None:
+        job.future.add_done_callback(lambda _: streamer.end())
+        try:
+            for text in streamer:
+                if ctx.cancelled():
+                    job.cancel()
+                if text:
+                    ctx.emit("text", text)
+        finally:
+            if not job.future.done():
+                job.cancel()
+    reply = finalize_text(payload.get("stop_rules") or [], job.future.result()).strip()
+    return {"reply": reply, "usage": job.usage()}
+
+
+def run_local(model_id: str, task: str, payload: Dict, ctx: TaskContext):
+    # Assisted chat decodes its own row, so it does not join the shared batch.
+    if task == "chat" and CHAT_CONTINUOUS_BATCHING and not payload.get("assist"):
+        return _chat_batched(model_id, payload, ctx)
+    with model_pool.acquire(model_id) as (model, tokenizer):
+        return TASKS[task](model_id, model, tokenizer, payload, ctx)
+
+
+# --- WORKER PROCESSES ---
+
+def _worker_main(model_id: str, cores: List[int], conn):
+    """Entry point of a stage worker process: pin, load the model once, then serve tasks."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    threads = str(len(cores))
+    os.environ["OMP_NUM_THREADS"] = threads
+    os.environ["MKL_NUM_THREADS"] = threads
+
+    import torch
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+    model_pool.idle_ttl = 0  # this process exists to keep its model resident
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    model_pool.warmup([model_id])
+    if model_id in model_pool.warmup_errors:
+        send(("failed", os.getpid(), model_pool.warmup_errors[model_id]))
+        return
+    send(("ready", os.getpid()))
+
+    contexts: Dict[int, TaskContext] = {}
+    executor = ThreadPoolExecutor(max_workers=WORKER_TASK_THREADS, thread_name_prefix="stage-task")
+    running = [0]
+    running_lock = threading.Lock()
+
+    def _execute(request_id: int, task: str, payload: Dict):
+        ctx = contexts[request_id]
+        # A task gets the pinned cores it shares with the tasks running when it starts
+        # (all of them when it runs alone), instead of oversubscribing them.
+        with running_lock:
+            running[0] += 1
+            torch.set_num_threads(max(1, len(cores) // running[0]))
+        try:
+            send(("result", request_id, run_local(model_id, task, payload, ctx)))
+        except OverloadedError as e:
+            send(("overloaded", request_id, e.retry_after))
+        except Exception as e:
+            send(("error", request_id, f"{type(e).__name__}: {e}"))
+        finally:
+            contexts.pop(request_id, None)
+            with running_lock:
+                running[0] -= 1
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        kind = message[0]
+        if kind == "run":
+            _, request_id, task, payload = message
+            contexts[request_id] = TaskContext(
+                emit=lambda k, data, rid=request_id: send(("event", rid, k, data)))
+            executor.submit(_execute, request_id, task, payload)
+        elif kind == "cancel":
+            ctx = contexts.get(message[1])
+            if ctx:
+                ctx.cancel_event.set()
+        elif kind == "stop":
+            break
+
+
+class WorkerUnavailableError(RuntimeError):
+    pass
+
+
+class StageWorker:
+    """API-process handle for one pinned worker process; requests are multiplexed over a pipe."""
+
+    def __init__(self, model_id: str, cores: List[int]):
+        self.model_id = model_id
+        self.cores = cores
+        self.process = None
+        self.ready = False
+        self.error: Optional[str] = None
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending: Dict[int, tuple] = {}
+        self._pending_lock = threading.Lock()
+
+    def start(self):
+        import multiprocessing as mp
+
+        ctx = mp.get_context("spawn")  # never fork a process that may already hold torch threads
+        parent, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(self.model_id, self.cores, child),
+                                   name=f"stage-worker:{self.model_id}", daemon=True)
+        self.process.start()
+        self._conn = parent
+        threading.Thread(target=self._reader, name=f"stage-reader:{self.model_id}", daemon=True).start()
+        print(f"--- Started worker for {self.model_id} on cores {self.cores} (pid {self.process.pid}) ---")
+
+    def _send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    @property
+    def usable(self) -> bool:
+        return self.ready and self.error is None and self.process is not None and self.process.is_alive()
+
+    def _mark_failed(self, reason: str):
+        """The process is gone (or its pipe is): stop routing to it and fail whatever was in flight."""
+        self.ready = False
+        self.error = self.error or reason
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError(f"Worker for {self.model_id} exited."))
+
+    def submit(self, task: str, payload: Dict, emit: Optional[Callable[[str, object], None]] = None) -> TaskHandle:
+        """Raises WorkerUnavailableError if the worker cannot take the task (nothing was started)."""
+        request_id = next(self._ids)
+        future: Future = Future()
+        with self._pending_lock:
+            if not self.usable:
+                raise WorkerUnavailableError(f"Worker for {self.model_id} is not available ({self.error or 'starting'}).")
+            self._pending[request_id] = (future, emit)
+        try:
+            self._send(("run", request_id, task, payload))
+        except (OSError, ValueError) as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            self._mark_failed(f"pipe closed: {e}")
+            raise WorkerUnavailableError(f"Worker for {self.model_id} is not available ({self.error}).")
+        return TaskHandle(future, cancel=lambda: self._cancel(request_id))
+
+    def _cancel(self, request_id: int):
+        try:
+            self._send(("cancel", request_id))
+        except (OSError, ValueError):
+            pass  # the worker is gone; its reader already failed the request
+
+    def _reader(self):
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "ready":
+                self.ready = True
+                print(f"🔥 Worker for {self.model_id} ready (pid {message[1]})")
+            elif kind == "failed":
+                self.error = message[2]
+                print(f"Worker Error ({self.model_id}): {self.error}")
+            elif kind == "event":
+                _, request_id, event_kind, data = message
+                with self._pending_lock:
+                    future, emit = self._pending.get(request_id, (None, None))
+                if emit:
+                    emit(event_kind, data)
+            elif kind in ("result", "error", "overloaded"):
+                with self._pending_lock:
+                    future, _ = self._pending.pop(message[1], (None, None))
+                if future is None:
+                    continue
+                if kind == "result":
+                    future.set_result(message[2])
+                elif kind == "overloaded":
+                    future.set_exception(OverloadedError(self.model_id, retry_after=message[2]))
+                else:
+                    future.set_exception(RuntimeError(message[2]))
+        # Worker died (or never got ready): requests go back to in-process execution.
+        self._mark_failed("worker process exited")
+        print(f"Worker Error ({self.model_id}): {self.error}; running its tasks in-process")
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            try:
+                self._send(("stop",))
+            except (OSError, ValueError):
+                pass
+            self.process.join(timeout=10)
+
+    def stats(self) -> Dict:
+        return {
+            "pid": self.process.pid if self.process else None,
+            "cores": self.cores,
+            "alive": bool(self.process and self.process.is_alive()),
+            "ready": self.ready,
+            "routed": self.usable,
+            "in_flight": len(self._pending),
+            "error": self.error,
+        }
+
+
+class WorkerPool:
+    def __init__(self, assignments: Dict[str, List[int]]):
+        self.workers = {model_id: StageWorker(model_id, cores) for model_id, cores in assignments.items()}
+
+    def start(self):
+        for worker in self.workers.values():
+            if worker.process is None:
+                worker.start()
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def get(self, model_id: str) -> Optional[StageWorker]:
+        """The model's worker if it can take tasks now; None means run in-process."""
+        worker = self.workers.get(model_id)
+        return worker if worker is not None and worker.usable else None
+
+    def covers(self, model_ids: List[str]) -> bool:
+        return all(self.get(model_id) is not None for model_id in model_ids)
+
+    def stats(self) -> Dict:
+        return {model_id: worker.stats() for model_id, worker in self.workers.items()}
+
+
+# Configured worker processes (started from the API's lifespan, never in the workers themselves).
+worker_pool = WorkerPool(parse_worker_config(STAGE_WORKERS_CONFIG))
+
+
+def submit_model_task(model_id: str, task: str, payload: Dict,
+                      emit: Optional[Callable[[str, object], None]] = None) -> TaskHandle:
+    """Starts a task without blocking; local tasks get their own thread."""
+    worker = worker_pool.get(model_id)
+    if worker is not None:
+        try:
+            return worker.submit(task, payload, emit)
+        except WorkerUnavailableError:
+            pass  # died since get(); fall through to in-process
+    ctx = TaskContext(emit)
+    future: Future = Future()
+
+    def _run():
+        init_inference_thread()
+        try:
+            future.set_result(run_local(model_id, task, payload, ctx))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_run, name=f"task:{task}", daemon=True).start()
+    return TaskHandle(future, cancel=ctx.cancel_event.set)
+
+
+def run_model_task(model_id: str, task: str, payload: Dict,
+                   emit: Optional[Callable[[str, object], None]] = None):
+    """Runs a task to completion; in-process tasks run on the calling thread."""
+    worker = worker_pool.get(model_id)
+    if worker is not None:
+        try:
+            handle = worker.submit(task, payload, emit)
+        except WorkerUnavailableError:
+            handle = None
+        if handle is not None:
+            return handle.future.result()
+    return run_local(model_id, task, payload, TaskContext(emit))
@@ -29,6 +29,7 @@ function DocumentationGenerator({ templateConfig, onBack }) {
   const [progressText, setProgressText] = useState('');
   const [error, setError] = useState(null);
   const [generatedData, setGeneratedData] = useState(null);
+  const [partialSections, setPartialSections] = useState({});
 
   const fileInputRef = useRef(null);
 
@@ -268,8 +269,10 @@ function DocumentationGenerator({ templateConfig, onBack }) {
       formData.append('project_description', projectDescription);
       formData.append('domain', domain);
       formData.append('template', templateConfig.headings.join('\n'));
+      formData.append('stream', 'true');
 
       setProgressText("Analyzing code & Generating content...");
+      setPartialSections({});
 
       const response = await fetch(`${API_URL}/generate-doc`, {
         method: 'POST',
@@ -281,8 +284,48 @@ function DocumentationGenerator({ templateConfig, onBack }) {
         throw new Error(errJson.detail || "Generation failed on server.");
       }
 
-      const data = await response.json();
-      setGeneratedData(data);
+      // NDJSON progress stream: one event per line, sections arrive as they finish.
+      const stageLabels = { 1: "Summarizing sections", 2: "Drafting sections", 3: "Polishing sections" };
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let result = null;
+
+      const handleEvent = (evt) => {
+        switch (evt.event) {
+          case 'stage_start':
+            setProgressText(`Stage ${evt.stage}/3: ${stageLabels[evt.stage] || evt.name}...`);
+            break;
+          case 'draft':
+            setProgressText(`Drafted: ${evt.heading}`);
+            setPartialSections(prev => ({ ...prev, [evt.heading]: evt.content }));
+            break;
+          case 'section':
+            setProgressText(`Finished: ${evt.heading}`);
+            setPartialSections(prev => ({ ...prev, [evt.heading]: evt.content }));
+            break;
+          case 'done':
+            result = { project_name: evt.project_name, domain: evt.domain, sections: evt.sections };
+            break;
+          case 'error':
+            throw new Error(evt.detail || "Generation failed on server.");
+          default:
+            break;
+        }
+      };
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+      }
+      if (buffer.trim()) handleEvent(JSON.parse(buffer));
+
+      if (!result) throw new Error("Generation stream ended unexpectedly.");
+      setGeneratedData(result);
       setProgressText("Done!");
     } catch (err) {
       console.error(err);
@@ -405,6 +448,17 @@ function DocumentationGenerator({ templateConfig, onBack }) {
           <div className="doc-progress-section">
             <div className="doc-spinner"></div>
             <p>{progressText}</p>
+            {Object.keys(partialSections).length > 0 && (
+              <div className="heading-preview-list">
+                {Object.entries(partialSections).map(([heading, content]) => (
+                  <div key={heading} className="heading-item">
+                    <CheckCircle size={14} color="#10B981" style={{marginRight: 6}}/>
+                    <b>{heading}</b>
+                    <p style={{whiteSpace: 'pre-wrap', fontSize: '0.85em', color: '#666'}}>{content.slice(0, 400)}</p>
+                  </div>
+                ))}
+              </div>
+            )}
           </div>
         )}
 